@@ -1,31 +1,131 @@
+import datetime
 import logging
+import os
 import sqlite3
-from typing import List
+from enum import Enum
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.request import pathname2url
 
 from pythoncommons.date_utils import DateUtils
 from pythoncommons.string_utils import auto_str
 
 from googlechrometoolkit.constants import GOOGLE_CHROME_HIST_DB_TEXT
+from googlechrometoolkit.sorting import Ordering, SortKey
 
 LOG = logging.getLogger(__name__)
+HISTORY_COLUMNS = "title, url, last_visit_time, visit_count"
+HISTORY_ORDER_BY_COLUMNS = {"title", "url", "last_visit_time", "visit_count"}
+CROSS_PROFILE_ORDER_BY_COLUMNS = HISTORY_ORDER_BY_COLUMNS | {"profile"}
+
+
+class CrossProfileQuery(Enum):
+    MERGED = "merged"
+    DEDUPLICATED = "dedup"
+    DIFF = "diff"
+
+
+def _convert_chrome_datetime(microseconds):
+    """
+    Since Google Chrome stores the last visit time with microseconds passed since
+    1601-01-01T00:00:00Z (Windows epoch),
+    the number of milliseconds of stored date need to be added to the date of
+    1601-01-01 to get the correct date value.
+    :param microseconds:
+    :return:
+    """
+    return DateUtils.add_microseconds_to_win_epoch(microseconds)
+
+
+def _convert_to_chrome_time(dt: datetime.datetime) -> int:
+    """
+    Inverse of _convert_chrome_datetime: Converts a datetime to microseconds passed since the Windows epoch.
+    :param dt:
+    :return:
+    """
+    delta = dt - DateUtils.WIN_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
 
 
 @auto_str
 class ChromeHistoryEntry:
-    def __init__(self, title, url, last_visit_time, visit_count):
+    def __init__(self, title, url, last_visit_time, visit_count, profile=None):
         self.title = title
         self.url = url
         self.last_visit_time = last_visit_time
         self.visit_count = visit_count
+        self.profile = profile
 
     def __repr__(self):
         return str(self.__dict__)
 
 
+class ChromeDbRow:
+    """
+    Generic row of any Chrome DB, values are accessible as attributes.
+    """
+
+    def __init__(self, values: Dict[str, Any]):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+def build_history_where(from_date: Optional[datetime.datetime], to_date: Optional[datetime.datetime],
+                        filter_match: Optional[str], table_alias="u"):
+    """
+    Builds the WHERE clause and its parameters for filtering the urls table by date range and match.
+    """
+    conditions = []
+    params = []
+    if from_date:
+        conditions.append("{}.last_visit_time >= ?".format(table_alias))
+        params.append(_convert_to_chrome_time(from_date))
+    if to_date:
+        conditions.append("{}.last_visit_time <= ?".format(table_alias))
+        params.append(_convert_to_chrome_time(to_date))
+    if filter_match:
+        conditions.append("instr({}.url, ?) > 0".format(table_alias))
+        params.append(filter_match)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, params
+
+
+def build_order_by(sort_keys: Optional[List[SortKey]], columns=HISTORY_ORDER_BY_COLUMNS):
+    """
+    Builds the ORDER BY clause of sort keys, ordering by last visit time descending by default.
+    Column names are validated against the allowed columns, as they can't be bound as parameters.
+    """
+    if not sort_keys:
+        return " ORDER BY last_visit_time DESC"
+    terms = []
+    for sort_key in sort_keys:
+        column = sort_key.field.get_key()
+        if column not in columns:
+            raise ValueError("Cannot order by column: '{}'. Available columns: {}".format(column, sorted(columns)))
+        terms.append("{} {}".format(column, "DESC" if sort_key.ordering == Ordering.DESC else "ASC"))
+    return " ORDER BY " + ", ".join(terms)
+
+
+def _to_read_only_uri(db_file):
+    return "file:{}?mode=ro".format(pathname2url(os.path.abspath(db_file)))
+
+
 class ChromeDb:
-    def __init__(self, db_file):
+    def __init__(self, db_file, read_only=False, check_same_thread=True):
         self.db_file = db_file
-        self.conn = sqlite3.connect(self.db_file)
+        if read_only:
+            self.conn = sqlite3.connect(_to_read_only_uri(self.db_file), uri=True,
+                                        check_same_thread=check_same_thread)
+        else:
+            self.conn = sqlite3.connect(self.db_file, check_same_thread=check_same_thread)
+
+    def close(self):
+        self.conn.close()
+
+    def query_rows(self, query, params=()) -> Iterator[tuple]:
+        LOG.debug("Executing query on %s: %s", self.db_file, query)
+        return self.conn.execute(query, params)
 
     def query_db_tables(self):
         cursor = self.conn.cursor()
@@ -35,21 +135,116 @@ class ChromeDb:
         result = cursor.fetchall()
         return result, columns
 
-    def query_history_entries(self) -> List[ChromeHistoryEntry]:
-        def _convert_chrome_datetime(microseconds):
-            """
-            Since Google Chrome stores the last visit time with microseconds passed since
-            1601-01-01T00:00:00Z (Windows epoch),
-            the number of milliseconds of stored date need to be added to the date of
-            1601-01-01 to get the correct date value.
-            :param microseconds:
-            :return:
-            """
-            return DateUtils.add_microseconds_to_win_epoch(microseconds)
-
+    def query_history_entries(self, order_by: List[SortKey] = None) -> Iterator[ChromeHistoryEntry]:
+        """
+        Rows are streamed from the cursor, the query is executed when the result is first iterated.
+        """
         c = self.conn.cursor()
-        query = "select title, url, last_visit_time, visit_count from urls order by last_visit_time desc"
+        query = "select title, url, last_visit_time, visit_count from urls" + build_order_by(order_by)
         c.execute(query)
-        results = c.fetchall()
-        result_objs = [ChromeHistoryEntry(r[0], r[1], _convert_chrome_datetime(r[2]), r[3]) for r in results]
-        return result_objs
+        for r in c:
+            yield ChromeHistoryEntry(r[0], r[1], _convert_chrome_datetime(r[2]), r[3])
+
+    def count_history_entries(self, from_date=None, to_date=None, filter_match=None) -> int:
+        where, params = build_history_where(from_date, to_date, filter_match)
+        return self.conn.execute("SELECT count(*) FROM urls AS u{}".format(where), params).fetchone()[0]
+
+    def query_history_entries_page(self, limit, offset=0, from_date=None, to_date=None,
+                                   filter_match=None) -> List[ChromeHistoryEntry]:
+        """
+        Queries one page of history entries, ordered by last visit time descending.
+        """
+        where, params = build_history_where(from_date, to_date, filter_match)
+        query = ("SELECT u.title, u.url, u.last_visit_time, u.visit_count FROM urls AS u{} "
+                 "ORDER BY u.last_visit_time DESC LIMIT ? OFFSET ?").format(where)
+        c = self.conn.execute(query, params + [limit, offset])
+        return [ChromeHistoryEntry(r[0], r[1], _convert_chrome_datetime(r[2]), r[3]) for r in c]
+
+
+class MultiProfileChromeDb:
+    """
+    Attaches the History DB of multiple profiles read-only to a single SQLite connection,
+    so that cross-profile operations (merge, deduplication, difference) are executed by SQLite
+    and only the final result is streamed back.
+    """
+
+    def __init__(self, db_files_by_profile: Dict[str, str]):
+        self.db_files_by_profile = db_files_by_profile
+        self.schemas_by_profile: Dict[str, str] = {}
+        self.conn = sqlite3.connect("file::memory:", uri=True)
+        for idx, (profile, db_file) in enumerate(db_files_by_profile.items()):
+            self._attach(profile, db_file, "profile_{}".format(idx))
+
+    def _attach(self, profile, db_file, schema):
+        uri = _to_read_only_uri(db_file)
+        LOG.info("Attaching %s of profile '%s' as '%s': %s", GOOGLE_CHROME_HIST_DB_TEXT, profile, schema, db_file)
+        try:
+            self.conn.execute("ATTACH DATABASE ? AS {}".format(schema), (uri,))
+        except sqlite3.OperationalError as e:
+            raise ValueError("Cannot attach {} of profile '{}': {}. Number of profiles: {}"
+                             .format(GOOGLE_CHROME_HIST_DB_TEXT, profile, e, len(self.db_files_by_profile))) from e
+        self.schemas_by_profile[profile] = schema
+
+    def close(self):
+        self.conn.close()
+
+    def _get_schema(self, profile):
+        if profile not in self.schemas_by_profile:
+            raise ValueError("Unknown profile: {}. Available profiles: {}"
+                             .format(profile, list(self.schemas_by_profile.keys())))
+        return self.schemas_by_profile[profile]
+
+    def _build_union_all(self, from_date, to_date, filter_match):
+        where, where_params = build_history_where(from_date, to_date, filter_match)
+        selects = []
+        params = []
+        for profile, schema in self.schemas_by_profile.items():
+            selects.append("SELECT ? AS profile, u.title, u.url, u.last_visit_time, u.visit_count "
+                           "FROM {}.urls AS u{}".format(schema, where))
+            params.append(profile)
+            params.extend(where_params)
+        return " UNION ALL ".join(selects), params
+
+    def _execute(self, query, params) -> Iterator[ChromeHistoryEntry]:
+        LOG.debug("Executing cross-profile query: %s, params: %s", query, params)
+        cursor = self.conn.execute(query, params)
+        for r in cursor:
+            yield ChromeHistoryEntry(r[1], r[2], _convert_chrome_datetime(r[3]), r[4], profile=r[0])
+
+    def query_merged(self, from_date=None, to_date=None, filter_match=None,
+                     order_by: List[SortKey] = None) -> Iterator[ChromeHistoryEntry]:
+        """
+        Merged timeline of all profiles, one row per profile and URL.
+        """
+        union, params = self._build_union_all(from_date, to_date, filter_match)
+        query = "SELECT profile, {} FROM ({}){}".format(HISTORY_COLUMNS, union,
+                                                       build_order_by(order_by, CROSS_PROFILE_ORDER_BY_COLUMNS))
+        return self._execute(query, params)
+
+    def query_deduplicated(self, from_date=None, to_date=None, filter_match=None,
+                           order_by: List[SortKey] = None) -> Iterator[ChromeHistoryEntry]:
+        """
+        One row per URL across all profiles: Visit counts are summed, the latest visit time is kept.
+        The profile column lists all profiles the URL was visited in.
+        As max() is used, SQLite returns the title of the row having the latest visit time.
+        """
+        union, params = self._build_union_all(from_date, to_date, filter_match)
+        query = ("SELECT group_concat(DISTINCT profile) AS profile, title, url, "
+                 "max(last_visit_time) AS last_visit_time, sum(visit_count) AS visit_count "
+                 "FROM ({}) GROUP BY url{}").format(union, build_order_by(order_by, CROSS_PROFILE_ORDER_BY_COLUMNS))
+        return self._execute(query, params)
+
+    def query_only_in(self, profile, other_profile, from_date=None, to_date=None,
+                      filter_match=None, order_by: List[SortKey] = None) -> Iterator[ChromeHistoryEntry]:
+        """
+        URLs visited in profile but never visited in other_profile.
+        """
+        schema = self._get_schema(profile)
+        other_schema = self._get_schema(other_profile)
+        where, params = build_history_where(from_date, to_date, filter_match)
+        not_exists = "NOT EXISTS (SELECT 1 FROM {}.urls AS o WHERE o.url = u.url)".format(other_schema)
+        where = where + " AND " + not_exists if where else " WHERE " + not_exists
+        query = ("SELECT ? AS profile, u.title AS title, u.url AS url, u.last_visit_time AS last_visit_time, "
+                 "u.visit_count AS visit_count FROM {}.urls AS u{}{}").format(
+            schema, where, build_order_by(order_by, CROSS_PROFILE_ORDER_BY_COLUMNS))
+        return self._execute(query, [profile] + params)
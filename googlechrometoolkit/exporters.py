@@ -1,7 +1,7 @@
+import csv
 import logging
 from enum import Enum
-import copy
-from typing import Dict, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from pythoncommons.date_utils import DateUtils
 from pythoncommons.string_utils import StringUtils
@@ -9,6 +9,8 @@ from tabulate import tabulate
 
 from pythoncommons.file_utils import FileUtils
 
+from googlechrometoolkit.sorting import DEFAULT_MEMORY_BUDGET_MB, ExternalSorter, Ordering, SortedRows, SortKey
+
 HEADER_ROW_NUMBER = "Row #"
 IGNORED_HEADERS = {HEADER_ROW_NUMBER}
 
@@ -22,11 +24,6 @@ class ExportMode(Enum):
     ALL = "all"
 
 
-class Ordering(Enum):
-    ASC = "ASC"
-    DESC = "DESC"
-
-
 class FieldType(Enum):
     SIMPLE_STR = "simple_str"
     URL = "url"
@@ -41,6 +38,10 @@ class Field(Enum):
     URL = "URL", 'url', FieldType.URL, 100
     LAST_VISIT_TIME = "Last visit time", 'last_visit_time', FieldType.DATETIME, -1
     VISIT_COUNT = "Visit count", "visit_count", int, -1
+    PROFILE = "Profile", "profile", FieldType.SIMPLE_STR, 40
+
+    def get_display_name(self):
+        return self.value[0]
 
     def get_key(self):
         return self.value[1]
@@ -71,15 +72,28 @@ class TruncateConfig:
 
 class DataConverter:
     def __init__(self, src_data, fields, row_stats, truncate_config: TruncateConfig, order_by, ordering,
-                 add_row_numbers=False):
+                 add_row_numbers=False, sort_memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        """
+        :param src_data: Iterable of rows, consumed only once. Rows may be streamed, e.g. from a DB cursor.
+        :param order_by: Either a single field, ordered by the specified ordering, or a list of SortKeys.
+        None if the source data is already ordered.
+        :param ordering: Ordering of a single order_by field
+        :param sort_memory_budget_mb: Above this size, the source data is sorted with an external merge sort
+        and stored in temporary files until close() is called
+        """
         self.src_data = src_data
         self.fields = fields
-        self.headers = [f.value[0] for f in fields]
+        self.headers = [f.get_display_name() for f in fields]
         self.row_stats = row_stats
         self.truncate_config: TruncateConfig = truncate_config
-        self.order_by = order_by.get_key()
-        self.ordering = ordering
+        self.sort_keys: List[SortKey] = []
+        if isinstance(order_by, list):
+            self.sort_keys = order_by
+        elif order_by:
+            self.sort_keys = [SortKey(order_by, ordering)]
         self.add_row_numbers = add_row_numbers
+        self.sort_memory_budget_mb = sort_memory_budget_mb
+        self._sorted_rows: Optional[SortedRows] = None
 
     @staticmethod
     def _modify_dict_value(row_dict, key, value, new_value):
@@ -90,19 +104,37 @@ class DataConverter:
     def _make_html_link(url):
         return "<a href=\"{url}\">{text}</a>".format(url=url, text=url)
 
-    def convert(self, export_mode):
-        # Make a copy of the data as other export methods may use the same data objects afterwards!
-        data = copy.deepcopy(self.src_data)
-
-        if self.order_by:
-            LOG.info("Ordering data by field '%s', ordering: %s", self.order_by, self.ordering)
-            reverse = False if self.ordering == Ordering.ASC else True
-            data = sorted(data, key=lambda data: getattr(data, self.order_by), reverse=reverse)
-
-        if self.add_row_numbers:
+    def sort(self) -> SortedRows:
+        """
+        Consumes and sorts the source data. It is sorted only once, then reused by the conversions of all export modes.
+        """
+        if self._sorted_rows is None:
+            if self.sort_keys:
+                LOG.info("Ordering data by: %s", ", ".join("{} {}".format(k.field.get_key(), k.ordering.value)
+                                                           for k in self.sort_keys))
+            sorter = ExternalSorter(self.sort_keys, memory_budget_mb=self.sort_memory_budget_mb)
+            self._sorted_rows = sorter.sort(self.src_data)
+            # Don't keep the consumed source data alive next to the sorted rows
+            self.src_data = None
+        return self._sorted_rows
+
+    def close(self):
+        if self._sorted_rows is not None:
+            self._sorted_rows.close()
+
+    def convert(self, export_mode) -> List[List[str]]:
+        return list(self.iter_converted_rows(export_mode))
+
+    def iter_converted_rows(self, export_mode) -> Iterator[List[str]]:
+        """
+        Lazily converts the sorted rows, so that an export can be written row by row.
+        """
+        # The source data is never modified, as other export methods may use the same data objects afterwards!
+        data = self.sort()
+
+        if self.add_row_numbers and HEADER_ROW_NUMBER not in self.fields:
             self.fields.insert(0, HEADER_ROW_NUMBER)
 
-        converted_data = []
         row_number = 1
         for d in data:
             row_dict = {header: getattr(d, header.get_key())
@@ -130,11 +162,10 @@ class DataConverter:
                 if field not in IGNORED_HEADERS:
                     row.append(row_dict[field])
 
-            converted_data.append(row)
+            yield row
             row_number += 1
 
         self.row_stats.print_stats()
-        return converted_data
 
     def convert_str_field(self, field: Field, value, export_mode):
         truncate = self.truncate_config.get(field, export_mode)
@@ -203,11 +234,13 @@ class ResultPrinter:
 
     @staticmethod
     def print_table_csv(converter, to_file):
+        # Rows are written one by one, so sorted rows stored in temporary files are never loaded into memory at once
         FileUtils.ensure_file_exists_and_writable(to_file)
-        converted_data = converter.convert(ExportMode.CSV)
-        tabulated = tabulate(converted_data, converter.headers, tablefmt="csv")
         LOG.info("Writing results to file: %s", to_file)
-        FileUtils.write_to_file(to_file, tabulated)
+        with open(to_file, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(([HEADER_ROW_NUMBER] if converter.add_row_numbers else []) + converter.headers)
+            writer.writerows(converter.iter_converted_rows(ExportMode.CSV))
 
     @staticmethod
     def print_table_fancy_grid(converter, to_file):
@@ -0,0 +1,204 @@
+import datetime
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Dict, List, Optional, Tuple, Union
+
+from pythoncommons.date_utils import DateUtils
+from pythoncommons.string_utils import auto_str
+
+from googlechrometoolkit.database import ChromeDb, ChromeDbRow
+from googlechrometoolkit.exporters import Field, FieldType
+
+LOG = logging.getLogger(__name__)
+UNIX_EPOCH = datetime.datetime(1970, 1, 1)
+ALL_SOURCES = "all"
+
+
+class TimestampEpoch(Enum):
+    # Microseconds passed since 1601-01-01T00:00:00Z, used by most of the Chrome DBs
+    WINDOWS = "windows"
+    # Seconds passed since 1970-01-01T00:00:00Z, used by e.g. the autofill table of Web Data
+    UNIX = "unix"
+
+    def convert(self, value) -> Optional[datetime.datetime]:
+        # Chrome stores 0 for timestamps that were never set
+        if not value:
+            return None
+        if self == TimestampEpoch.WINDOWS:
+            return DateUtils.add_microseconds_to_win_epoch(value)
+        return UNIX_EPOCH + datetime.timedelta(seconds=value)
+
+
+class Column:
+    """
+    Generic counterpart of exporters.Field, for columns of extractor sources.
+    Provides the same interface as Field so that it can be used with DataConverter, RowStats and TruncateConfig.
+    """
+
+    def __init__(self, display_name, key, field_type, max_length=-1):
+        self.display_name = display_name
+        self.key = key
+        self.field_type = field_type
+        self.max_length = max_length
+
+    def get_display_name(self):
+        return self.display_name
+
+    def get_key(self):
+        return self.key
+
+    def get_type(self):
+        return self.field_type
+
+    def get_max_length(self):
+        return self.max_length
+
+    def __repr__(self):
+        return "Column.{}".format(self.key)
+
+
+@auto_str
+class ExtractorSource:
+    """
+    Describes how to extract rows from one of the SQLite DBs of a Chrome profile.
+    The columns of the query must be in the same order as the declared columns.
+    Columns already defined by exporters.Field are declared with the Field member itself.
+    Values of DATETIME columns are converted from the declared timestamp epoch.
+    date_column and match_column specify the columns used for filtering by date range and match, if any.
+    """
+
+    def __init__(self, name: str, file_name: str, query: str, columns: List[Union[Column, Field]],
+                 epoch: TimestampEpoch = TimestampEpoch.WINDOWS,
+                 date_column: Optional[str] = None, match_column: Optional[str] = None,
+                 order_by: Optional[str] = None):
+        self.name = name
+        self.file_name = file_name
+        self.query = query
+        self.columns = columns
+        self.epoch = epoch
+        self.date_column = date_column
+        self.match_column = match_column
+        self.order_by = order_by
+
+    def get_column(self, key) -> Optional[Union[Column, Field]]:
+        for c in self.columns:
+            if c.get_key() == key:
+                return c
+        return None
+
+    def convert_row(self, row) -> ChromeDbRow:
+        values = {}
+        for column, value in zip(self.columns, row):
+            if column.get_type() == FieldType.DATETIME:
+                value = self.epoch.convert(value)
+            values[column.get_key()] = value
+        return ChromeDbRow(values)
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+EXTRACTOR_SOURCES: Dict[str, ExtractorSource] = {}
+
+
+def register_source(source: ExtractorSource):
+    if source.name in EXTRACTOR_SOURCES:
+        raise ValueError("Extractor source '{}' is already registered!".format(source.name))
+    EXTRACTOR_SOURCES[source.name] = source
+
+
+def get_sources(names: List[str]) -> List[ExtractorSource]:
+    if ALL_SOURCES in names:
+        return list(EXTRACTOR_SOURCES.values())
+    return [EXTRACTOR_SOURCES[name] for name in names]
+
+
+register_source(ExtractorSource(
+    "history", "History",
+    "SELECT title, url, last_visit_time, visit_count FROM urls",
+    [Field.TITLE, Field.URL, Field.LAST_VISIT_TIME, Field.VISIT_COUNT],
+    date_column="last_visit_time", match_column="url", order_by="last_visit_time"))
+
+register_source(ExtractorSource(
+    "top_sites", "Top Sites",
+    "SELECT url_rank, title, url FROM top_sites",
+    [
+        Column("Rank", "url_rank", int),
+        Column("Title", "title", FieldType.SIMPLE_STR, 70),
+        Column("URL", "url", FieldType.URL, 100),
+    ],
+    match_column="url"))
+
+register_source(ExtractorSource(
+    "favicons", "Favicons",
+    "SELECT m.page_url, f.url, max(b.last_updated) FROM icon_mapping AS m "
+    "JOIN favicons AS f ON f.id = m.icon_id "
+    "LEFT JOIN favicon_bitmaps AS b ON b.icon_id = f.id "
+    "GROUP BY m.page_url, f.url",
+    [
+        Column("Page URL", "page_url", FieldType.URL, 100),
+        Column("Icon URL", "icon_url", FieldType.URL, 100),
+        Column("Last updated", "last_updated", FieldType.DATETIME),
+    ],
+    date_column="last_updated", match_column="page_url", order_by="last_updated"))
+
+register_source(ExtractorSource(
+    "autofill", "Web Data",
+    "SELECT name, value, count, date_created, date_last_used FROM autofill",
+    [
+        Column("Name", "name", FieldType.SIMPLE_STR, 50),
+        Column("Value", "value", FieldType.SIMPLE_STR, 70),
+        Column("Count", "count", int),
+        Column("Date created", "date_created", FieldType.DATETIME),
+        Column("Date last used", "date_last_used", FieldType.DATETIME),
+    ],
+    epoch=TimestampEpoch.UNIX, date_column="date_last_used", order_by="date_last_used"))
+
+register_source(ExtractorSource(
+    "shortcuts", "Shortcuts",
+    "SELECT text, contents, url, last_access_time, number_of_hits FROM omni_box_shortcuts",
+    [
+        Column("Text", "text", FieldType.SIMPLE_STR, 50),
+        Column("Contents", "contents", FieldType.SIMPLE_STR, 70),
+        Column("URL", "url", FieldType.URL, 100),
+        Column("Last access time", "last_access_time", FieldType.DATETIME),
+        Column("Number of hits", "number_of_hits", int),
+    ],
+    date_column="last_access_time", match_column="url", order_by="last_access_time"))
+
+
+class ExtractorRunner:
+    """
+    Reads the DB files of extractor sources in parallel.
+    Every DB file is read in a worker thread, with its own read-only connection.
+    SQLite releases the GIL while executing queries, so a complete profile dump takes about as long
+    as reading its largest DB.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers
+
+    @staticmethod
+    def _extract(source: ExtractorSource, db_file: str) -> List[ChromeDbRow]:
+        LOG.info("Extracting '%s' from DB file: %s", source.name, db_file)
+        chrome_db = ChromeDb(db_file, read_only=True)
+        try:
+            return [source.convert_row(r) for r in chrome_db.query_rows(source.query)]
+        except sqlite3.Error as e:
+            # Schemas of Chrome DBs change between Chrome versions, a failing source should not fail the whole dump
+            LOG.error("Failed to extract '%s' from DB file: %s. Error: %s", source.name, db_file, e)
+            return []
+        finally:
+            chrome_db.close()
+
+    def extract(self, db_files: Dict[Tuple[str, str], str]) -> Dict[Tuple[str, str], List[ChromeDbRow]]:
+        """
+        :param db_files: DB files, keyed by (profile, source name)
+        :return: Extracted rows, keyed by (profile, source name)
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {key: executor.submit(self._extract, EXTRACTOR_SOURCES[key[1]], db_file)
+                       for key, db_file in db_files.items()}
+            return {key: future.result() for key, future in futures.items()}
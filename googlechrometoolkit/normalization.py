@@ -0,0 +1,150 @@
+import hashlib
+import logging
+from enum import Enum
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List
+from urllib.parse import SplitResult, urlsplit, urlunsplit
+
+from googlechrometoolkit.database import ChromeHistoryEntry
+
+LOG = logging.getLogger(__name__)
+DEFAULT_CACHE_SIZE = 65536
+DIGEST_SIZE = 16
+HTTP_SCHEMES = {"http", "https"}
+# Default ports of the HTTP schemes, dropped when schemes are unified
+DEFAULT_PORTS = {"80", "443"}
+TRACKING_PARAM_PREFIXES = ("utm_",)
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid",
+                   "_ga", "_gl", "ref_src"}
+PROFILE_SEP = ","
+
+
+class UrlRule(Enum):
+    DROP_FRAGMENT = "drop-fragment"
+    DROP_TRACKING_PARAMS = "drop-tracking-params"
+    UNIFY_SCHEME = "unify-scheme"
+    STRIP_TRAILING_SLASH = "strip-trailing-slash"
+    LOWERCASE_HOST = "lowercase-host"
+    STRIP_WWW = "strip-www"
+    SORT_QUERY = "sort-query"
+
+
+DEFAULT_URL_RULES = [UrlRule.DROP_FRAGMENT, UrlRule.DROP_TRACKING_PARAMS, UrlRule.UNIFY_SCHEME,
+                     UrlRule.STRIP_TRAILING_SLASH, UrlRule.LOWERCASE_HOST]
+
+
+class UrlCanonicalizer:
+    """
+    Canonicalizes URLs according to the configured rules, only http and https URLs are modified.
+    Hosts and query parameter names repeat heavily across history entries,
+    so their canonical forms are memoized with bounded LRU caches.
+    """
+
+    def __init__(self, rules: Iterable[UrlRule] = None, cache_size=DEFAULT_CACHE_SIZE):
+        self.rules = frozenset(rules if rules is not None else DEFAULT_URL_RULES)
+        self._canonicalize_netloc = lru_cache(maxsize=cache_size)(self._canonicalize_netloc_uncached)
+        self._is_tracking_param = lru_cache(maxsize=cache_size)(self._is_tracking_param_uncached)
+
+    def _canonicalize_netloc_uncached(self, netloc: str) -> str:
+        if UrlRule.LOWERCASE_HOST in self.rules:
+            netloc = netloc.lower()
+        if UrlRule.STRIP_WWW in self.rules:
+            userinfo, sep, host = netloc.rpartition("@")
+            if host.lower().startswith("www."):
+                netloc = userinfo + sep + host[4:]
+        if UrlRule.UNIFY_SCHEME in self.rules:
+            host, sep, port = netloc.rpartition(":")
+            if sep and port in DEFAULT_PORTS:
+                netloc = host
+        return netloc
+
+    @staticmethod
+    def _is_tracking_param_uncached(name: str) -> bool:
+        name = name.lower()
+        return name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES)
+
+    def _canonicalize_query(self, query: str) -> str:
+        if not query:
+            return query
+        params = query.split("&")
+        if UrlRule.DROP_TRACKING_PARAMS in self.rules:
+            params = [p for p in params if p and not self._is_tracking_param(p.partition("=")[0])]
+        if UrlRule.SORT_QUERY in self.rules:
+            params.sort()
+        return "&".join(params)
+
+    def canonicalize(self, url: str) -> str:
+        try:
+            parts: SplitResult = urlsplit(url)
+        except ValueError as e:
+            # E.g. invalid IPv6 netloc: 'http://[::1'
+            LOG.debug("Cannot parse URL, keeping it as is: %s. Error: %s", url, e)
+            return url
+        scheme = parts.scheme.lower()
+        if scheme not in HTTP_SCHEMES:
+            return url
+        if UrlRule.UNIFY_SCHEME in self.rules:
+            scheme = "https"
+        path = parts.path
+        if UrlRule.STRIP_TRAILING_SLASH in self.rules:
+            path = path.rstrip("/")
+        fragment = "" if UrlRule.DROP_FRAGMENT in self.rules else parts.fragment
+        return urlunsplit((scheme, self._canonicalize_netloc(parts.netloc), path,
+                           self._canonicalize_query(parts.query), fragment))
+
+    def cache_info(self):
+        return {"netloc": self._canonicalize_netloc.cache_info(), "params": self._is_tracking_param.cache_info()}
+
+
+class HistoryEntryDeduplicator:
+    """
+    Merges history entries having the same canonical URL: Visit counts are summed, the latest visit time is kept.
+    The merged entry keeps the original URL and title of its most recent visit.
+    Entries are indexed by a fixed size digest of the canonical URL,
+    so canonical URLs are not kept in memory next to the original ones.
+    Merged entries are released as they are consumed, so they can be streamed to e.g. an external sort.
+    """
+
+    def __init__(self, canonicalizer: UrlCanonicalizer):
+        self.canonicalizer = canonicalizer
+
+    def _digest(self, url: str) -> bytes:
+        canonical_url = self.canonicalizer.canonicalize(url)
+        return hashlib.blake2b(canonical_url.encode("utf-8", errors="surrogatepass"), digest_size=DIGEST_SIZE).digest()
+
+    @staticmethod
+    def _merge(merged: ChromeHistoryEntry, entry: ChromeHistoryEntry):
+        merged.visit_count = (merged.visit_count or 0) + (entry.visit_count or 0)
+        if entry.last_visit_time > merged.last_visit_time:
+            merged.title = entry.title
+            merged.url = entry.url
+            merged.last_visit_time = entry.last_visit_time
+        if entry.profile and merged.profile != entry.profile:
+            profiles = merged.profile.split(PROFILE_SEP) if merged.profile else []
+            for profile in entry.profile.split(PROFILE_SEP):
+                if profile not in profiles:
+                    profiles.append(profile)
+            merged.profile = PROFILE_SEP.join(profiles)
+
+    def deduplicate(self, entries: Iterable[ChromeHistoryEntry]) -> Iterator[ChromeHistoryEntry]:
+        index: Dict[bytes, int] = {}
+        result: List[ChromeHistoryEntry] = []
+        count = 0
+        for entry in entries:
+            count += 1
+            digest = self._digest(entry.url)
+            idx = index.get(digest)
+            if idx is None:
+                index[digest] = len(result)
+                # Source entries are not modified, as other exports may use them afterwards
+                result.append(ChromeHistoryEntry(entry.title, entry.url, entry.last_visit_time, entry.visit_count,
+                                                 profile=entry.profile))
+            else:
+                self._merge(result[idx], entry)
+        LOG.info("Deduplicated %d history entries to %d entries by canonical URL", count, len(result))
+        LOG.debug("URL canonicalizer cache info: %s", self.canonicalizer.cache_info())
+        index.clear()
+        for idx in range(len(result)):
+            entry = result[idx]
+            result[idx] = None
+            yield entry
@@ -0,0 +1,266 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from enum import Enum
+from itertools import groupby
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pythoncommons.string_utils import auto_str
+
+from googlechrometoolkit.sorting import DEFAULT_MEMORY_BUDGET_MB, ExternalSorter, Ordering, SortKey
+
+LOG = logging.getLogger(__name__)
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+UNDATED_PARTITION = "undated"
+FINGERPRINT_BITS = 128
+
+
+class PartitionGranularity(Enum):
+    MONTH = "month"
+    WEEK = "week"
+
+    def get_partition_key(self, dt: Optional[datetime.datetime]) -> str:
+        if dt is None:
+            return UNDATED_PARTITION
+        if self == PartitionGranularity.MONTH:
+            return dt.strftime("%Y-%m")
+        iso_year, iso_week, _ = dt.isocalendar()
+        return "{:04d}-W{:02d}".format(iso_year, iso_week)
+
+
+@auto_str
+class Partition:
+    """
+    Row count, time range and fingerprint of the rows of a partition. The rows themselves are not kept.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.row_count = 0
+        self.min_time: Optional[datetime.datetime] = None
+        self.max_time: Optional[datetime.datetime] = None
+        self._hash_sum = 0
+
+    def add(self, dt: Optional[datetime.datetime], row_values: Tuple):
+        self.row_count += 1
+        if dt is not None:
+            self.min_time = dt if self.min_time is None else min(self.min_time, dt)
+            self.max_time = dt if self.max_time is None else max(self.max_time, dt)
+        # Sum of row digests: The fingerprint doesn't depend on the order of rows
+        digest = hashlib.blake2b(repr(row_values).encode("utf-8", errors="surrogatepass"),
+                                 digest_size=FINGERPRINT_BITS // 8).digest()
+        self._hash_sum = (self._hash_sum + int.from_bytes(digest, "big")) % (1 << FINGERPRINT_BITS)
+
+    @property
+    def fingerprint(self) -> str:
+        return "{}-{:032x}".format(self.row_count, self._hash_sum)
+
+    def to_manifest_entry(self, files: List[str]) -> Dict:
+        return {
+            "row_count": self.row_count,
+            "fingerprint": self.fingerprint,
+            "min_time": self.min_time.isoformat() if self.min_time else None,
+            "max_time": self.max_time.isoformat() if self.max_time else None,
+            "files": files,
+        }
+
+    def __repr__(self):
+        return str({"key": self.key, "row_count": self.row_count, "fingerprint": self.fingerprint})
+
+
+def track_partitions(rows: Iterable, granularity: PartitionGranularity, date_attr, fields,
+                     partitions: Dict[str, Partition]) -> Iterator:
+    """
+    Lazily passes through the rows, adding each of them to the partition of the time period of its date attribute.
+    The fingerprint of partitions is computed from the values of the fields.
+    """
+    keys = [f.get_key() for f in fields]
+    for row in rows:
+        dt = getattr(row, date_attr)
+        key = granularity.get_partition_key(dt)
+        if key not in partitions:
+            partitions[key] = Partition(key)
+        partitions[key].add(dt, tuple(getattr(row, k) for k in keys))
+        yield row
+
+
+class PartitionManifest:
+    """
+    Records the partitions written to a partitioned export dir, per profile:
+    Row count, fingerprint, time range and files of each partition.
+    Partitions are only valid with the same granularity and export settings.
+    """
+
+    def __init__(self, export_dir, granularity: PartitionGranularity, settings: str):
+        self.file = os.path.join(export_dir, MANIFEST_FILE_NAME)
+        self.granularity = granularity
+        self.settings = settings
+        self.profiles: Dict[str, Dict[str, Dict]] = {}
+
+    @staticmethod
+    def load(export_dir, granularity: PartitionGranularity, settings: str) -> "PartitionManifest":
+        manifest = PartitionManifest(export_dir, granularity, settings)
+        if not os.path.isfile(manifest.file):
+            return manifest
+        try:
+            with open(manifest.file, encoding="utf-8") as f:
+                d = json.load(f)
+        except (OSError, ValueError) as e:
+            LOG.warning("Ignoring unreadable partition manifest %s: %s", manifest.file, e)
+            return manifest
+        manifest.profiles = d.get("profiles", {})
+        if (d.get("version") != MANIFEST_VERSION or d.get("granularity") != granularity.value
+                or d.get("settings") != settings):
+            LOG.info("Partition granularity or export settings changed, all partitions will be rewritten")
+            # Entries are kept without fingerprints, so that their files are removed but never reused
+            for partitions in manifest.profiles.values():
+                for entry in partitions.values():
+                    entry["fingerprint"] = None
+        return manifest
+
+    def get_partitions(self, profile) -> Dict[str, Dict]:
+        return self.profiles.get(profile, {})
+
+    def set_partitions(self, profile, partitions: Dict[str, Dict]):
+        self.profiles[profile] = partitions
+
+    def save(self):
+        d = {
+            "version": MANIFEST_VERSION,
+            "granularity": self.granularity.value,
+            "settings": self.settings,
+            "profiles": self.profiles,
+        }
+        tmp_file = self.file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(d, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.file)
+
+
+def _write_partition(converter, targets):
+    try:
+        for func, filename in targets:
+            func(converter, filename)
+    finally:
+        converter.close()
+
+
+class PartitionedExporter:
+    """
+    Writes one file per partition (month or week), profile and format, into a stable export dir.
+    Partitions having the same fingerprint as recorded in the manifest and all of their files present are skipped.
+    Files of partitions that no longer exist are removed.
+    Rows are grouped by partition with an external sort by their date, within the memory budget.
+    Only the rows of changed partitions are read back, each of them is sorted within the memory budget as well.
+    Partitions are converted and written in parallel, in worker threads.
+    """
+
+    def __init__(self, export_dir, granularity: PartitionGranularity, settings: str, max_workers=None,
+                 memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        self.export_dir = export_dir
+        self.granularity = granularity
+        self.manifest = PartitionManifest.load(export_dir, granularity, settings)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.memory_budget_mb = memory_budget_mb
+
+    def _is_up_to_date(self, partition: Partition, entry: Optional[Dict], files: List[str]) -> bool:
+        if not entry or entry.get("fingerprint") != partition.fingerprint:
+            return False
+        if set(entry.get("files", [])) != set(files):
+            return False
+        return all(os.path.isfile(os.path.join(self.export_dir, f)) for f in files)
+
+    def export(self, profile, rows, date_field, fields,
+               converter_factory: Callable[[Iterable], object],
+               targets_factory: Callable[[str], List[Tuple[Callable, str]]]):
+        """
+        :param profile: Name of the exported profile, prefix of partition file names
+        :param rows: Rows of the profile, consumed only once
+        :param date_field: Field of rows used for partitioning
+        :param fields: Exported fields, used for fingerprinting partitions
+        :param converter_factory: Creates a DataConverter of the rows of a partition.
+        The converter must order the rows itself, as they are grouped by date.
+        :param targets_factory: Returns the export functions and file names of a partition name
+        """
+        date_attr = date_field.get_key()
+        partitions: Dict[str, Partition] = {}
+        sorter = ExternalSorter([SortKey(date_field, Ordering.ASC)], memory_budget_mb=self.memory_budget_mb)
+        with sorter.sort(track_partitions(rows, self.granularity, date_attr, fields, partitions)) as rows_by_date:
+            old_entries = self.manifest.get_partitions(profile)
+            new_entries = {}
+            tasks = {}
+            for key, partition in partitions.items():
+                targets = targets_factory("{}-{}".format(profile, key))
+                files = [os.path.basename(filename) for _, filename in targets]
+                if self._is_up_to_date(partition, old_entries.get(key), files):
+                    new_entries[key] = old_entries[key]
+                else:
+                    tasks[key] = (partition, targets, files)
+            LOG.info("Profile '%s': %d partitions, %d changed, %d up to date",
+                     profile, len(partitions), len(tasks), len(partitions) - len(tasks))
+            errors = self._write_partitions(profile, rows_by_date, date_attr, tasks, new_entries, converter_factory)
+
+        if errors:
+            # The partitions written successfully are recorded, so the next run doesn't rewrite them.
+            # Stale files are only removed after a complete run: All other entries are kept without fingerprints,
+            # so the next run rewrites their partitions, or removes their files if the partitions no longer exist.
+            for key, entry in old_entries.items():
+                if key not in new_entries:
+                    new_entries[key] = dict(entry, fingerprint=None)
+        else:
+            self._remove_stale_files(old_entries, new_entries)
+        self.manifest.set_partitions(profile, new_entries)
+        self.manifest.save()
+        if errors:
+            raise errors[0]
+
+    def _write_partitions(self, profile, rows_by_date, date_attr, tasks, new_entries, converter_factory) -> List:
+        if not tasks:
+            return []
+        errors = []
+        futures = {}
+        pending = set()
+        groups = groupby(rows_by_date, key=lambda row: self.granularity.get_partition_key(getattr(row, date_attr)))
+        # Writing a partition is mostly I/O and formatting, threads avoid pickling the rows to other processes
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for key, partition_rows in groups:
+                if key not in tasks:
+                    continue
+                converter = converter_factory(partition_rows)
+                try:
+                    # Rows of the partition are consumed here, before moving on to the rows of the next partition
+                    converter.sort()
+                except Exception as e:
+                    converter.close()
+                    LOG.error("Failed to sort partition '%s' of profile '%s': %s", key, profile, e)
+                    errors.append(e)
+                    continue
+                futures[key] = executor.submit(_write_partition, converter, tasks[key][1])
+                pending.add(futures[key])
+                if len(pending) >= self.max_workers:
+                    # Limits the number of sorted partitions waiting to be written
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for key, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    LOG.error("Failed to write partition '%s' of profile '%s': %s", key, profile, e)
+                    errors.append(e)
+                    continue
+                partition, _, files = tasks[key]
+                new_entries[key] = partition.to_manifest_entry(files)
+        return errors
+
+    def _remove_stale_files(self, old_entries, new_entries):
+        current_files = {f for entry in new_entries.values() for f in entry["files"]}
+        for entry in old_entries.values():
+            for f in entry.get("files", []):
+                path = os.path.join(self.export_dir, f)
+                if f not in current_files and os.path.isfile(path):
+                    LOG.info("Removing file of stale partition: %s", path)
+                    os.remove(path)
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from pythoncommons.string_utils import auto_str
+
+LOG = logging.getLogger(__name__)
+LOCAL_STATE_FILE_NAME = "Local State"
+DISCOVERY_CACHE_VERSION = 1
+
+# Profile directories that are never listed in Local State's profile.info_cache but may still hold a History DB
+EXTRA_PROFILE_DIR_NAMES = ["Guest Profile", "System Profile"]
+
+# Directories of the Chrome user data dir that hold caches / web storage and never contain profile DBs.
+# These can be gigabytes in size, so they are skipped when falling back to walking the directory tree.
+PRUNED_DIR_NAMES = {
+    "Application Cache",
+    "blob_storage",
+    "BrowserMetrics",
+    "Cache",
+    "Code Cache",
+    "Crashpad",
+    "databases",
+    "Download Service",
+    "Extension Rules",
+    "Extension State",
+    "Extensions",
+    "File System",
+    "GPUCache",
+    "GrShaderCache",
+    "GraphiteDawnCache",
+    "IndexedDB",
+    "Local Extension Settings",
+    "Local Storage",
+    "optimization_guide_model_store",
+    "Safe Browsing",
+    "Service Worker",
+    "Session Storage",
+    "ShaderCache",
+    "Snapshots",
+    "Storage",
+    "Sync Extension Settings",
+    "VideoDecodeStats",
+    "WasmTtsEngine",
+    "WidevineCdm",
+}
+
+
+def get_profile_key(dir_name: str) -> str:
+    # Profile directory name may contains spaces, e.g. "Profile 1"
+    return dir_name.lower().replace(" ", "")
+
+
+@auto_str
+class ChromeProfile:
+    def __init__(self, dir_name: str, display_name: str, db_file: str):
+        self.dir_name = dir_name
+        self.display_name = display_name
+        self.db_file = db_file
+
+    @property
+    def key(self) -> str:
+        return get_profile_key(self.dir_name)
+
+    @property
+    def profile_dir(self) -> str:
+        return os.path.dirname(self.db_file)
+
+    def matches(self, profile: str) -> bool:
+        profile = profile.lower()
+        return profile == self.key or profile == self.display_name.lower()
+
+    def to_dict(self):
+        return {"dir_name": self.dir_name, "display_name": self.display_name, "db_file": self.db_file}
+
+    @staticmethod
+    def from_dict(d):
+        return ChromeProfile(d["dir_name"], d["display_name"], d["db_file"])
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+class ProfileDiscovery:
+    """
+    Finds the DB files of Chrome profiles without walking the whole Chrome user data dir.
+    The list of profiles and their display names are read from the 'profile.info_cache' of the 'Local State' file,
+    only the known profile directories are checked for the DB file.
+    If 'Local State' is missing or unreadable, a walk of the directory tree is performed,
+    skipping the known cache directories (see PRUNED_DIR_NAMES).
+    Results are cached in a JSON file, keyed by the modification time of 'Local State'.
+    """
+
+    def __init__(self, basedir: str, file_name: str, cache_file: Optional[str] = None):
+        self.basedir = basedir
+        self.file_name = file_name
+        self.cache_file = cache_file
+        self.local_state_file = os.path.join(self.basedir, LOCAL_STATE_FILE_NAME)
+
+    def discover(self) -> List[ChromeProfile]:
+        local_state_mtime = self._get_local_state_mtime()
+        if local_state_mtime is not None:
+            profiles = self._load_from_cache(local_state_mtime)
+            if profiles is not None:
+                LOG.info("Using cached profile discovery results of %s", self.basedir)
+                return profiles
+
+        info_cache = self._read_profile_info_cache()
+        if info_cache is not None:
+            profiles = self._discover_from_info_cache(info_cache)
+        else:
+            LOG.info("Cannot read profiles from '%s', searching DB files under: %s",
+                     LOCAL_STATE_FILE_NAME, self.basedir)
+            profiles = self._discover_by_pruned_walk()
+
+        if local_state_mtime is not None:
+            self._store_to_cache(local_state_mtime, profiles)
+        return profiles
+
+    def _get_local_state_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.local_state_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_profile_info_cache(self) -> Optional[Dict[str, Dict]]:
+        try:
+            with open(self.local_state_file, encoding="utf-8") as f:
+                local_state = json.load(f)
+            info_cache = local_state["profile"]["info_cache"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            LOG.debug("Failed to read profile info cache from %s: %s", self.local_state_file, e)
+            return None
+        if not isinstance(info_cache, dict):
+            return None
+        return info_cache
+
+    def _discover_from_info_cache(self, info_cache: Dict[str, Dict]) -> List[ChromeProfile]:
+        display_names = {dir_name: (info or {}).get("name") or dir_name for dir_name, info in info_cache.items()}
+        for dir_name in EXTRA_PROFILE_DIR_NAMES:
+            display_names.setdefault(dir_name, dir_name)
+
+        profiles = []
+        for dir_name in sorted(display_names):
+            db_file = self._find_file_in_dir(os.path.join(self.basedir, dir_name))
+            if db_file:
+                profiles.append(ChromeProfile(dir_name, display_names[dir_name], db_file))
+        return profiles
+
+    def _find_file_in_dir(self, dir_path) -> Optional[str]:
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.name == self.file_name and entry.is_file():
+                        return entry.path
+        except OSError:
+            pass
+        return None
+
+    def _discover_by_pruned_walk(self) -> List[ChromeProfile]:
+        profiles: Dict[str, ChromeProfile] = {}
+        for dirpath, dirnames, filenames in os.walk(self.basedir):
+            dirnames[:] = sorted(d for d in dirnames if d not in PRUNED_DIR_NAMES)
+            if self.file_name in filenames:
+                dir_name = os.path.basename(dirpath)
+                profile = ChromeProfile(dir_name, dir_name, os.path.join(dirpath, self.file_name))
+                if profile.key in profiles:
+                    # Dirs are walked in sorted order, so the same DB file is kept on every run
+                    LOG.warning("Skipping %s, found another DB file for profile '%s': %s",
+                                profile.db_file, profile.key, profiles[profile.key].db_file)
+                    continue
+                profiles[profile.key] = profile
+        return list(profiles.values())
+
+    def _cache_key(self):
+        return "{}{}{}".format(os.path.abspath(self.basedir), os.sep, self.file_name)
+
+    def _read_cache_file(self) -> Dict:
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            LOG.warning("Ignoring unreadable profile discovery cache %s: %s", self.cache_file, e)
+            return {}
+        if not isinstance(cache, dict) or cache.get("version") != DISCOVERY_CACHE_VERSION:
+            return {}
+        return cache
+
+    def _load_from_cache(self, local_state_mtime: int) -> Optional[List[ChromeProfile]]:
+        entry = self._read_cache_file().get("entries", {}).get(self._cache_key())
+        if not entry or entry.get("local_state_mtime") != local_state_mtime:
+            return None
+        profiles = [ChromeProfile.from_dict(d) for d in entry["profiles"]]
+        if not all(os.path.isfile(p.db_file) for p in profiles):
+            return None
+        return profiles
+
+    def _store_to_cache(self, local_state_mtime: int, profiles: List[ChromeProfile]):
+        if not self.cache_file:
+            return
+        cache = self._read_cache_file()
+        cache["version"] = DISCOVERY_CACHE_VERSION
+        cache.setdefault("entries", {})[self._cache_key()] = {
+            "local_state_mtime": local_state_mtime,
+            "profiles": [p.to_dict() for p in profiles],
+        }
+        try:
+            with open(self.cache_file, "w", encoding="utf-8") as f:
+                json.dump(cache, f, indent=2)
+        except OSError as e:
+            LOG.warning("Failed to write profile discovery cache %s: %s", self.cache_file, e)
@@ -0,0 +1,468 @@
+import asyncio
+import datetime
+import heapq
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from pythoncommons.string_utils import auto_str
+
+from googlechrometoolkit.database import ChromeDb, ChromeHistoryEntry
+
+LOG = logging.getLogger(__name__)
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 10000
+REQUEST_TIMEOUT_SECONDS = 10
+SNAPSHOT_FILE_PREFIX = "snapshot"
+MAX_SNAPSHOT_ATTEMPTS = 3
+
+
+class PoolClosedError(Exception):
+    """
+    Raised when a connection is requested from a pool that was closed because its snapshot was refreshed.
+    """
+    pass
+
+
+class ReadOnlyConnectionPool:
+    """
+    Pool of read-only ChromeDb connections of a DB file, usable from worker threads.
+    Connections are created lazily, up to the size of the pool.
+    """
+
+    def __init__(self, db_file, size=DEFAULT_POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+    @contextmanager
+    def connection(self):
+        chrome_db = self._acquire()
+        try:
+            yield chrome_db
+        finally:
+            self._release(chrome_db)
+
+    def _acquire(self) -> ChromeDb:
+        try:
+            return self._check_closed(self._idle.get_nowait())
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._closed:
+                raise PoolClosedError("Connection pool of DB file {} is closed".format(self.db_file))
+            if self._created < self.size:
+                self._created += 1
+                return ChromeDb(self.db_file, read_only=True, check_same_thread=False)
+        return self._check_closed(self._idle.get())
+
+    def _check_closed(self, chrome_db: Optional[ChromeDb]) -> ChromeDb:
+        if chrome_db is None:
+            # Sentinel of a closed pool, put back for the other waiting threads
+            self._idle.put(None)
+            raise PoolClosedError("Connection pool of DB file {} is closed".format(self.db_file))
+        return chrome_db
+
+    def _release(self, chrome_db: ChromeDb):
+        with self._lock:
+            if self._closed:
+                chrome_db.close()
+            else:
+                self._idle.put(chrome_db)
+
+    def close(self):
+        """
+        Closes idle connections, connections in use are closed when they are released.
+        """
+        with self._lock:
+            self._closed = True
+            while True:
+                try:
+                    chrome_db = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if chrome_db:
+                    chrome_db.close()
+            # Wakes up threads waiting for a connection
+            self._idle.put(None)
+
+
+class DbSnapshot:
+    """
+    Copy of the History DB of a profile, queried through a connection pool.
+    The copy is refreshed when the source DB file changes: The fingerprint of the snapshot is derived from
+    the size and modification time of the source file at the time of copying.
+    """
+
+    def __init__(self, profile, source_file, snapshots_dir, pool_size=DEFAULT_POOL_SIZE):
+        self.profile = profile
+        self.source_file = source_file
+        self.snapshots_dir = snapshots_dir
+        self.pool_size = pool_size
+        self.fingerprint: Optional[str] = None
+        self.snapshot_file: Optional[str] = None
+        self.pool: Optional[ReadOnlyConnectionPool] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_fingerprint(file) -> str:
+        st = os.stat(file)
+        return "{}-{}".format(st.st_size, st.st_mtime_ns)
+
+    def acquire(self) -> Tuple[str, ReadOnlyConnectionPool]:
+        """
+        Refreshes the snapshot if required.
+        :return: Fingerprint of the snapshot and its connection pool
+        """
+        fingerprint = self.get_fingerprint(self.source_file)
+        with self._lock:
+            if fingerprint != self.fingerprint:
+                self._refresh(fingerprint)
+            return self.fingerprint, self.pool
+
+    def _refresh(self, fingerprint):
+        self._generation += 1
+        snapshot_file = os.path.join(self.snapshots_dir,
+                                     "{}-{}-{}".format(SNAPSHOT_FILE_PREFIX, self.profile, self._generation))
+        LOG.info("Creating snapshot of DB file of profile '%s': %s -> %s",
+                 self.profile, self.source_file, snapshot_file)
+        shutil.copyfile(self.source_file, snapshot_file)
+        old_pool, old_snapshot_file = self.pool, self.snapshot_file
+        self.pool = ReadOnlyConnectionPool(snapshot_file, size=self.pool_size)
+        self.snapshot_file = snapshot_file
+        self.fingerprint = fingerprint
+        if old_pool:
+            old_pool.close()
+            self._remove_file(old_snapshot_file)
+
+    @staticmethod
+    def _remove_file(file):
+        try:
+            os.remove(file)
+        except OSError as e:
+            # On Windows, files can't be removed while in-flight queries still have them opened
+            LOG.warning("Failed to remove old snapshot file %s: %s", file, e)
+
+    def close(self):
+        with self._lock:
+            if self.pool:
+                self.pool.close()
+                self._remove_file(self.snapshot_file)
+            self.pool = None
+            self.snapshot_file = None
+            self.fingerprint = None
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of query results.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._d: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._d:
+                self._d.move_to_end(key)
+                self.hits += 1
+                return self._d[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._d[key] = value
+            self._d.move_to_end(key)
+            while len(self._d) > self.max_size:
+                self._d.popitem(last=False)
+
+    def invalidate_profile(self, profile):
+        with self._lock:
+            for key in [k for k in self._d if profile in k[0]]:
+                del self._d[key]
+
+
+@auto_str
+class HistoryQuery:
+    def __init__(self, profiles: Tuple[str, ...], from_date=None, to_date=None, filter_match=None,
+                 limit=DEFAULT_PAGE_SIZE, offset=0):
+        self.profiles = profiles
+        self.from_date = from_date
+        self.to_date = to_date
+        self.filter_match = filter_match
+        self.limit = limit
+        self.offset = offset
+
+    @staticmethod
+    def _parse_date(value: Optional[str]) -> Optional[datetime.datetime]:
+        if not value:
+            return None
+        try:
+            dt = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError("Invalid date: '{}'. The date must be in ISO 8601 format, for example: YYYY-MM-DD"
+                             .format(value))
+        if dt.tzinfo is not None:
+            # Chrome timestamps are in UTC, dates with an UTC offset are converted to naive UTC dates
+            dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return dt
+
+    @staticmethod
+    def _parse_int(params, name, default, min_value, max_value):
+        value = params.get(name, default)
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError("Invalid value of parameter '{}': {}".format(name, value))
+        if not min_value <= value <= max_value:
+            raise ValueError("Value of parameter '{}' must be between {} and {}".format(name, min_value, max_value))
+        return value
+
+    @staticmethod
+    def from_params(params: Dict[str, str], available_profiles: List[str]):
+        profile = params.get("profile")
+        if profile:
+            if profile not in available_profiles:
+                raise ValueError("Unknown profile: {}. Available profiles: {}".format(profile, available_profiles))
+            profiles = (profile,)
+        else:
+            profiles = tuple(available_profiles)
+        return HistoryQuery(profiles,
+                            from_date=HistoryQuery._parse_date(params.get("from")),
+                            to_date=HistoryQuery._parse_date(params.get("to")),
+                            filter_match=params.get("match"),
+                            limit=HistoryQuery._parse_int(params, "limit", DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE),
+                            offset=HistoryQuery._parse_int(params, "offset", 0, 0, 2 ** 62))
+
+    def cache_key(self, fingerprints: Tuple[str, ...]):
+        return self.profiles, fingerprints, self.from_date, self.to_date, self.filter_match, self.limit, self.offset
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+class HistoryQueryService:
+    """
+    Runs paginated history queries against DB snapshots of profiles, results are cached until a snapshot changes.
+    Methods are blocking and meant to be called from worker threads.
+    """
+
+    def __init__(self, snapshots: Dict[str, DbSnapshot], cache_size=DEFAULT_CACHE_SIZE):
+        self.snapshots = snapshots
+        self.cache = ResultCache(max_size=cache_size)
+        self._fingerprints: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def profiles(self) -> List[str]:
+        return list(self.snapshots.keys())
+
+    def _acquire_snapshots(self, profiles) -> Tuple[Tuple[str, ...], List[ReadOnlyConnectionPool]]:
+        fingerprints = []
+        pools = []
+        for profile in profiles:
+            fingerprint, pool = self.snapshots[profile].acquire()
+            with self._lock:
+                if self._fingerprints.get(profile, fingerprint) != fingerprint:
+                    LOG.info("Snapshot of profile '%s' changed, invalidating cached results", profile)
+                    self.cache.invalidate_profile(profile)
+                self._fingerprints[profile] = fingerprint
+            fingerprints.append(fingerprint)
+            pools.append(pool)
+        return tuple(fingerprints), pools
+
+    @staticmethod
+    def _query_profile(profile, pool: ReadOnlyConnectionPool, query: HistoryQuery):
+        filter_kwargs = {"from_date": query.from_date, "to_date": query.to_date, "filter_match": query.filter_match}
+        with pool.connection() as chrome_db:
+            total = chrome_db.count_history_entries(**filter_kwargs)
+            # Entries of multiple profiles are merged, so all rows until the end of the requested page are needed
+            limit = query.limit if len(query.profiles) == 1 else query.offset + query.limit
+            offset = query.offset if len(query.profiles) == 1 else 0
+            entries = chrome_db.query_history_entries_page(limit, offset, **filter_kwargs)
+        for e in entries:
+            e.profile = profile
+        return total, entries
+
+    def query(self, query: HistoryQuery) -> Dict:
+        """
+        A snapshot may be refreshed after its pool was acquired, closing the pool.
+        In this case, the query is retried with the new snapshot.
+        """
+        for attempt in range(1, MAX_SNAPSHOT_ATTEMPTS + 1):
+            fingerprints, pools = self._acquire_snapshots(query.profiles)
+            key = query.cache_key(fingerprints)
+            result = self.cache.get(key)
+            if result is not None:
+                return result
+            try:
+                result = self._execute(query, pools)
+            except PoolClosedError as e:
+                if attempt == MAX_SNAPSHOT_ATTEMPTS:
+                    raise
+                LOG.debug("Snapshot was refreshed during query, retrying: %s", e)
+                continue
+            self.cache.put(key, result)
+            return result
+
+    def _execute(self, query: HistoryQuery, pools: List[ReadOnlyConnectionPool]) -> Dict:
+        total = 0
+        entries_by_profile = []
+        for profile, pool in zip(query.profiles, pools):
+            profile_total, entries = self._query_profile(profile, pool, query)
+            total += profile_total
+            entries_by_profile.append(entries)
+        if len(entries_by_profile) == 1:
+            entries = entries_by_profile[0]
+        else:
+            merged = heapq.merge(*entries_by_profile, key=lambda e: e.last_visit_time, reverse=True)
+            entries = list(islice(merged, query.offset, query.offset + query.limit))
+
+        return {
+            "profiles": list(query.profiles),
+            "total": total,
+            "limit": query.limit,
+            "offset": query.offset,
+            "entries": [self._entry_to_dict(e) for e in entries],
+        }
+
+    @staticmethod
+    def _entry_to_dict(entry: ChromeHistoryEntry):
+        return {
+            "profile": entry.profile,
+            "title": entry.title,
+            "url": entry.url,
+            "last_visit_time": entry.last_visit_time.isoformat(),
+            "visit_count": entry.visit_count,
+        }
+
+    def close(self):
+        for snapshot in self.snapshots.values():
+            snapshot.close()
+
+
+class HistoryQueryServer:
+    """
+    Minimal read-only HTTP/JSON API over HistoryQueryService, bound to localhost by default.
+    Endpoints:
+    GET /health
+    GET /profiles
+    GET /history?profile=<profile>&from=<YYYY-MM-DD>&to=<YYYY-MM-DD>&match=<str>&limit=<int>&offset=<int>
+    Queries are executed on worker threads, one request is served per connection.
+    """
+
+    def __init__(self, service: HistoryQueryService, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 max_workers=DEFAULT_POOL_SIZE):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> int:
+        """
+        :return: The bound port, useful if port 0 was specified
+        """
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        LOG.info("Serving history queries on http://%s:%d", self.host, self.port)
+        return self.port
+
+    async def serve_forever(self):
+        if not self._server:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        # Headers are not used, only consumed
+        while True:
+            line = await reader.readline()
+            if not line or line in (b"\r\n", b"\n"):
+                break
+        parts = request_line.split(" ")
+        if len(parts) != 3:
+            raise ValueError("Malformed request line: {}".format(request_line))
+        return parts[0], parts[1]
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                method, target = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT_SECONDS)
+            except (ValueError, asyncio.TimeoutError) as e:
+                status, body = HTTPStatus.BAD_REQUEST, {"error": str(e)}
+            else:
+                loop = asyncio.get_running_loop()
+                status, body = await loop.run_in_executor(self.executor, self._route, method, target)
+            await self._write_response(writer, status, body)
+        except ConnectionError as e:
+            LOG.debug("Client disconnected: %s", e)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _write_response(writer: asyncio.StreamWriter, status: HTTPStatus, body):
+        payload = json.dumps(body).encode("utf-8")
+        headers = ("HTTP/1.1 {} {}\r\n"
+                   "Content-Type: application/json; charset=utf-8\r\n"
+                   "Content-Length: {}\r\n"
+                   "Connection: close\r\n\r\n").format(status.value, status.phrase, len(payload))
+        writer.write(headers.encode("latin-1") + payload)
+        await writer.drain()
+
+    def _route(self, method, target):
+        if method != "GET":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "Method not allowed: {}".format(method)}
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            if url.path == "/health":
+                return HTTPStatus.OK, {"status": "ok"}
+            if url.path == "/profiles":
+                return HTTPStatus.OK, {"profiles": self.service.profiles}
+            if url.path == "/history":
+                profile = params.get("profile")
+                if profile and profile not in self.service.profiles:
+                    return HTTPStatus.NOT_FOUND, {"error": "Unknown profile: {}".format(profile)}
+                query = HistoryQuery.from_params(params, self.service.profiles)
+                return HTTPStatus.OK, self.service.query(query)
+            return HTTPStatus.NOT_FOUND, {"error": "Not found: {}".format(url.path)}
+        except PoolClosedError as e:
+            # Not an error of the client: The snapshot kept being refreshed during all attempts
+            LOG.warning("Failed to serve request: %s %s: %s", method, target, e)
+            return HTTPStatus.SERVICE_UNAVAILABLE, {"error": str(e)}
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        except Exception as e:
+            LOG.exception("Failed to serve request: %s %s", method, target)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
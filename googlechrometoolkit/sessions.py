@@ -0,0 +1,171 @@
+import logging
+import mmap
+import os
+import struct
+from enum import Enum
+from typing import Iterable, Iterator, List, Optional, Set
+
+from pythoncommons.string_utils import auto_str
+
+LOG = logging.getLogger(__name__)
+SNSS_SIGNATURE = b"SNSS"
+SESSIONS_DIR_NAME = "Sessions"
+CURRENT_SESSION_FILE_NAME = "Current Session"
+CURRENT_TABS_FILE_NAME = "Current Tabs"
+SESSION_FILE_PREFIX = "Session_"
+TABS_FILE_PREFIX = "Tabs_"
+DEFAULT_EXCLUDED_URL_PREFIXES = ("chrome://newtab", "chrome-search://local-ntp")
+
+# See components/sessions/core/command_storage_backend.cc: Version 2 and 4 are encrypted and not supported
+SUPPORTED_FILE_VERSIONS = {1, 3}
+FILE_HEADER = struct.Struct("<4si")
+COMMAND_SIZE = struct.Struct("<H")
+INT32 = struct.Struct("<i")
+# base::Pickle header (payload size), tab id, navigation index, length of the URL
+NAVIGATION_HEADER = struct.Struct("<Iiii")
+
+
+class SessionFileType(Enum):
+    """
+    Value is the ID of the UpdateTabNavigation command in the command stream of the file, see:
+    components/sessions/core/session_service_commands.cc and components/sessions/core/tab_restore_service_impl.cc
+    """
+    SESSION = 6
+    TABS = 1
+
+    @staticmethod
+    def from_file_name(file_name):
+        if file_name == CURRENT_TABS_FILE_NAME or file_name.startswith(TABS_FILE_PREFIX):
+            return SessionFileType.TABS
+        return SessionFileType.SESSION
+
+
+@auto_str
+class SessionNavigation:
+    def __init__(self, tab_id, index, url, title):
+        self.tab_id = tab_id
+        self.index = index
+        self.url = url
+        self.title = title
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+class SessionFileParser:
+    """
+    Streaming parser of SNSS files ('Current Session', 'Current Tabs', 'Sessions/Session_*', 'Sessions/Tabs_*').
+    The file is memory mapped and only the UpdateTabNavigation commands are decoded,
+    all other commands are skipped by their size.
+    """
+
+    def __init__(self, session_file: str, file_type: Optional[SessionFileType] = None):
+        self.session_file = session_file
+        self.file_type = file_type if file_type else SessionFileType.from_file_name(os.path.basename(session_file))
+
+    def iter_navigations(self, seen_urls: Optional[Set[bytes]] = None) -> Iterator[SessionNavigation]:
+        """
+        :param seen_urls: If specified, navigations with an URL in this set are skipped before decoding them
+        and the URLs of the yielded navigations are added to the set.
+        :return:
+        """
+        with open(self.session_file, "rb") as f:
+            if os.fstat(f.fileno()).st_size < FILE_HEADER.size:
+                LOG.warning("Session file is too short, skipping: %s", self.session_file)
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                yield from self._iter_navigations(buf, seen_urls)
+
+    def _iter_navigations(self, buf, seen_urls) -> Iterator[SessionNavigation]:
+        signature, version = FILE_HEADER.unpack_from(buf, 0)
+        if signature != SNSS_SIGNATURE:
+            raise ValueError("Not an SNSS file: {}".format(self.session_file))
+        if version not in SUPPORTED_FILE_VERSIONS:
+            raise ValueError("Unsupported SNSS file version {} of file: {}".format(version, self.session_file))
+
+        navigation_command_id = self.file_type.value
+        pos = FILE_HEADER.size
+        size = len(buf)
+        while pos + COMMAND_SIZE.size <= size:
+            command_size = COMMAND_SIZE.unpack_from(buf, pos)[0]
+            pos += COMMAND_SIZE.size
+            command_end = pos + command_size
+            if command_size == 0 or command_end > size:
+                # Truncated command at the end of a file that is still being written
+                break
+            if buf[pos] == navigation_command_id:
+                navigation = self._parse_navigation(buf, pos + 1, command_end, seen_urls)
+                if navigation:
+                    yield navigation
+            pos = command_end
+
+    def _parse_navigation(self, buf, start, end, seen_urls) -> Optional[SessionNavigation]:
+        """
+        Decodes the beginning of the base::Pickle payload of an UpdateTabNavigation command:
+        tab id (int32), index (int32), virtual URL (std::string), title (std::u16string).
+        Strings are prefixed with their length and padded to 4 bytes.
+        """
+        if start + NAVIGATION_HEADER.size > end:
+            return self._malformed(start)
+        _, tab_id, index, url_length = NAVIGATION_HEADER.unpack_from(buf, start)
+        pos = start + NAVIGATION_HEADER.size
+        if url_length < 0 or pos + url_length + INT32.size > end:
+            return self._malformed(start)
+        url_bytes = buf[pos:pos + url_length]
+        if seen_urls is not None:
+            if url_bytes in seen_urls:
+                return None
+            seen_urls.add(url_bytes)
+        pos += (url_length + 3) & ~3
+
+        title_length = INT32.unpack_from(buf, pos)[0] * 2
+        pos += INT32.size
+        if title_length < 0 or pos + title_length > end:
+            return self._malformed(start)
+        title = buf[pos:pos + title_length].decode("utf-16-le", errors="replace")
+        return SessionNavigation(tab_id, index, url_bytes.decode("utf-8", errors="replace"), title)
+
+    def _malformed(self, offset):
+        LOG.debug("Skipping malformed navigation command at offset %d of %s", offset, self.session_file)
+        return None
+
+
+def find_session_files(profile_dir: str) -> List[str]:
+    """
+    Returns the session files of a profile dir.
+    Older Chrome versions use 'Current Session' / 'Current Tabs' in the profile dir,
+    newer versions store 'Session_<timestamp>' / 'Tabs_<timestamp>' files in the 'Sessions' dir.
+    """
+    result = []
+    for file_name in [CURRENT_SESSION_FILE_NAME, CURRENT_TABS_FILE_NAME]:
+        path = os.path.join(profile_dir, file_name)
+        if os.path.isfile(path):
+            result.append(path)
+    sessions_dir = os.path.join(profile_dir, SESSIONS_DIR_NAME)
+    if os.path.isdir(sessions_dir):
+        with os.scandir(sessions_dir) as it:
+            result.extend(sorted(entry.path for entry in it
+                                 if entry.is_file() and entry.name.startswith((SESSION_FILE_PREFIX, TABS_FILE_PREFIX))))
+    return result
+
+
+def iter_unique_navigations(session_files: Iterable[str],
+                            excluded_url_prefixes=DEFAULT_EXCLUDED_URL_PREFIXES) -> Iterator[SessionNavigation]:
+    """
+    Lazily yields the navigations of all session files, every URL only once.
+    Duplicates are dropped by the parser based on the raw URL bytes, before decoding the navigation.
+    Navigations with an empty URL or an URL with an excluded prefix are skipped.
+    Unreadable files (e.g. encrypted, unsupported version or not an SNSS file) are logged and skipped.
+    """
+    seen_urls: Set[bytes] = set()
+    for session_file in session_files:
+        LOG.info("Parsing session file: %s", session_file)
+        try:
+            for navigation in SessionFileParser(session_file).iter_navigations(seen_urls):
+                url = navigation.url
+                if not url or url.startswith(excluded_url_prefixes):
+                    continue
+                yield navigation
+        except (OSError, ValueError) as e:
+            # A stray file or a file that is being written should not fail the whole export
+            LOG.error("Failed to parse session file: %s. Error: %s", session_file, e)
@@ -0,0 +1,195 @@
+import heapq
+import itertools
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from enum import Enum
+from typing import Iterable, Iterator, List
+
+from pythoncommons.string_utils import auto_str
+
+LOG = logging.getLogger(__name__)
+DEFAULT_MEMORY_BUDGET_MB = 256
+SORT_KEY_SEP = ","
+ORDERING_SEP = ":"
+
+
+class Ordering(Enum):
+    ASC = "ASC"
+    DESC = "DESC"
+
+
+@auto_str
+class SortKey:
+    def __init__(self, field, ordering: Ordering = Ordering.ASC):
+        self.field = field
+        self.ordering = ordering
+
+    @staticmethod
+    def parse(value: str, fields) -> List["SortKey"]:
+        """
+        Parses sort keys in the format of: <field key>[:asc|desc],<field key>[:asc|desc],...
+        :param value: String to parse
+        :param fields: Fields that can be used for ordering
+        :return:
+        """
+        fields_by_key = {f.get_key(): f for f in fields}
+        result = []
+        for part in value.split(SORT_KEY_SEP):
+            key, _, ordering = part.strip().partition(ORDERING_SEP)
+            if key not in fields_by_key:
+                raise ValueError("Unknown field to order by: '{}'. Available fields: {}"
+                                 .format(key, list(fields_by_key.keys())))
+            try:
+                ordering = Ordering(ordering.upper()) if ordering else Ordering.ASC
+            except ValueError:
+                raise ValueError("Unknown ordering: '{}'. Available orderings: {}"
+                                 .format(ordering, [o.value.lower() for o in Ordering]))
+            result.append(SortKey(fields_by_key[key], ordering))
+        return result
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+def _attr_key(attr):
+    # Missing values (e.g. unset timestamps) are treated as smaller than any other value, like NULLs in SQLite
+    return lambda row: (getattr(row, attr) is not None, getattr(row, attr))
+
+
+def sort_in_memory(rows: List, sort_keys: List[SortKey]) -> List:
+    """
+    Sorts rows in place by multiple keys, each key having its own ordering.
+    As list.sort is stable, sorting by the keys in reverse order gives the multi-key ordering.
+    """
+    for sort_key in reversed(sort_keys):
+        rows.sort(key=_attr_key(sort_key.field.get_key()), reverse=sort_key.ordering == Ordering.DESC)
+    return rows
+
+
+class _MergeKey:
+    """
+    Comparable key of a row for merging sorted runs, respecting the ordering of each sort key.
+    """
+    __slots__ = ("values", "descending")
+
+    def __init__(self, row, attrs, descending):
+        self.values = [(getattr(row, attr) is not None, getattr(row, attr)) for attr in attrs]
+        self.descending = descending
+
+    def __lt__(self, other):
+        for value, other_value, desc in zip(self.values, other.values, self.descending):
+            if value != other_value:
+                return value > other_value if desc else value < other_value
+        return False
+
+    def __eq__(self, other):
+        # Required for stable merging: heapq.merge compares the keys for equality first
+        return self.values == other.values
+
+
+def _read_run(run_file) -> Iterator:
+    with open(run_file, "rb") as f:
+        unpickler = pickle.Unpickler(f)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+
+
+class SortedRows:
+    """
+    Result of ExternalSorter: Rows that can be iterated multiple times without sorting them again.
+    Rows are either kept in memory or stored in temporary files as sorted runs, which are merged lazily
+    on every iteration. The temporary files are removed by close().
+    """
+
+    def __init__(self, rows: List, run_files: List[str], sort_keys: List[SortKey]):
+        self.rows = rows
+        self.run_files = run_files
+        self.sort_keys = sort_keys
+
+    def __iter__(self) -> Iterator:
+        if not self.run_files:
+            return iter(self.rows)
+        LOG.debug("Merging %d sorted runs", len(self.run_files))
+        runs = [_read_run(f) for f in self.run_files]
+        if not self.sort_keys:
+            return itertools.chain(*runs)
+        attrs = [k.field.get_key() for k in self.sort_keys]
+        descending = [k.ordering == Ordering.DESC for k in self.sort_keys]
+        if len(set(descending)) == 1:
+            # Same ordering for all keys: Plain tuples can be compared, which is much faster
+            return heapq.merge(*runs, key=lambda row: tuple((getattr(row, attr) is not None,
+                                                             getattr(row, attr)) for attr in attrs),
+                               reverse=descending[0])
+        return heapq.merge(*runs, key=lambda row: _MergeKey(row, attrs, descending))
+
+    def close(self):
+        for f in self.run_files:
+            os.remove(f)
+        self.run_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ExternalSorter:
+    """
+    Sorts rows by multiple keys within a memory budget.
+    Rows are consumed from the source iterable and buffered until the estimated size of the buffer
+    exceeds the budget, then the buffer is sorted and written to a temporary file as a sorted run.
+    If all rows fit into the budget, no files are written.
+    Without sort keys, rows are only spooled to the temporary files in their original order.
+    """
+
+    def __init__(self, sort_keys: List[SortKey], memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, tmp_dir=None):
+        self.sort_keys = sort_keys
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.tmp_dir = tmp_dir
+
+    @staticmethod
+    def _estimate_size(row) -> int:
+        values = row.__dict__
+        return sys.getsizeof(row) + sys.getsizeof(values) + sum(sys.getsizeof(v) for v in values.values())
+
+    def sort(self, rows: Iterable) -> SortedRows:
+        buffer = []
+        buffer_size = 0
+        run_files = []
+        try:
+            for row in rows:
+                buffer.append(row)
+                buffer_size += self._estimate_size(row)
+                if buffer_size >= self.memory_budget:
+                    run_files.append(self._write_run(buffer))
+                    buffer = []
+                    buffer_size = 0
+            if not run_files:
+                return SortedRows(sort_in_memory(buffer, self.sort_keys), [], self.sort_keys)
+            if buffer:
+                run_files.append(self._write_run(buffer))
+        except BaseException:
+            for f in run_files:
+                os.remove(f)
+            raise
+        LOG.info("Wrote %d sorted runs to temporary files", len(run_files))
+        return SortedRows([], run_files, self.sort_keys)
+
+    def _write_run(self, buffer) -> str:
+        sort_in_memory(buffer, self.sort_keys)
+        fd, run_file = tempfile.mkstemp(prefix="sorted-run-", suffix=".pickle", dir=self.tmp_dir)
+        LOG.debug("Writing sorted run of %d rows to %s", len(buffer), run_file)
+        with os.fdopen(fd, "wb") as f:
+            pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+            for row in buffer:
+                pickler.dump(row)
+                # Rows are independent, the memo would keep all of them alive
+                pickler.clear_memo()
+        return run_file
@@ -1,5 +1,5 @@
 #!/usr/bin/python
-from typing import List
+from typing import Dict, Iterable, Iterator, List
 
 from pythoncommons.date_utils import DateUtils
 from pythoncommons.file_utils import FileUtils
@@ -7,9 +7,15 @@ from pythoncommons.project_utils import ProjectUtils
 from pythoncommons.string_utils import auto_str
 
 from googlechrometoolkit.constants import GOOGLE_CHROME_HIST_DB_TEXT, GOOGLE_CHROME_HIST_DB_TEXT_PLURAL
-from googlechrometoolkit.database import ChromeDb, ChromeHistoryEntry
+from googlechrometoolkit.database import ChromeDb, ChromeHistoryEntry, CrossProfileQuery, MultiProfileChromeDb
 from googlechrometoolkit.exporters import DataConverter, Field, RowStats, ResultPrinter, FieldType, Ordering, \
     ExportMode, TruncateConfig
+from googlechrometoolkit.sorting import DEFAULT_MEMORY_BUDGET_MB, SortKey
+from googlechrometoolkit.extractors import ALL_SOURCES, EXTRACTOR_SOURCES, ExtractorRunner, get_sources
+from googlechrometoolkit.normalization import DEFAULT_URL_RULES, HistoryEntryDeduplicator, UrlCanonicalizer, UrlRule
+from googlechrometoolkit.partitioning import PartitionedExporter, PartitionGranularity
+from googlechrometoolkit.profiles import ChromeProfile, ProfileDiscovery
+from googlechrometoolkit.sessions import find_session_files, iter_unique_navigations
 import argparse
 import sys
 import logging
@@ -26,10 +32,16 @@ PROJECT_NAME = 'gchromehistoryexporter'
 HISTORY_FILE_NAME = 'History'
 DEFAULT_GOOGLE_CHROME_DIR = expanduser("~") + '/Library/Application Support/Google/Chrome/'
 EXPORTED_DIR_NAME_PREFIX = "exported-chrome-db"
+PARTITIONED_DIR_NAME_PREFIX = "partitioned-chrome-db"
+DISCOVERY_CACHE_FILE_NAME = "profile-discovery-cache.json"
 ALL_PROFILES = '*'
 FILE_PROFILE_SEP = '-'
 DEFAULT_FROM_DATETIME = DateUtils.get_datetime(1601, 1, 1)
 DEFAULT_TO_DATETIME = DateUtils.get_datetime(2399, 1, 1)
+HISTORY_FIELDS = [Field.TITLE, Field.URL, Field.LAST_VISIT_TIME, Field.VISIT_COUNT]
+CROSS_PROFILE_FIELDS = [Field.PROFILE] + HISTORY_FIELDS
+SESSION_TABS_FIELDS = [Field.TITLE, Field.URL]
+SESSION_TABS_EXPORT_NAME = "session-tabs"
 
 
 class Extension(Enum):
@@ -115,9 +127,68 @@ class Setup:
         parser.add_argument('-p', '--profile', default=ALL_PROFILES,
                             dest='profile',
                             type=str, required=False,
-                            help="Which profile to use. "
+                            help="Which profile to use. Either the profile directory name or the display name "
+                                 "of the profile can be specified. "
                                  "Default value is: '{}', which means export all profiles.".format(ALL_PROFILES))
 
+        parser.add_argument('--cross-profile-query', dest='cross_profile_query',
+                            type=str, choices=[q.value for q in CrossProfileQuery], required=False,
+                            help="Query the DB files of all profiles with a single connection. "
+                                 "'{}': Merged timeline of all profiles, "
+                                 "'{}': One row per URL across all profiles, "
+                                 "'{}': URLs visited in a profile but not in another one, see --diff-profiles"
+                            .format(CrossProfileQuery.MERGED.value, CrossProfileQuery.DEDUPLICATED.value,
+                                    CrossProfileQuery.DIFF.value))
+
+        parser.add_argument('--diff-profiles', dest='diff_profiles', nargs=2, metavar=('PROFILE', 'OTHER_PROFILE'),
+                            type=str, required=False,
+                            help="Profiles to compare with cross profile query '{}'"
+                            .format(CrossProfileQuery.DIFF.value))
+
+        parser.add_argument('--extract-sources', dest='extract_sources', nargs='+',
+                            type=str, choices=list(EXTRACTOR_SOURCES.keys()) + [ALL_SOURCES], required=False,
+                            help="Extract data from these SQLite DBs of the profiles instead of exporting the history. "
+                                 "The DBs are read in parallel. "
+                                 "Specify '{}' to extract all sources.".format(ALL_SOURCES))
+
+        parser.add_argument('--session-tabs', action='store_true',
+                            dest='is_session_tabs', default=False, required=False,
+                            help="Export the open and recently closed tabs from the session files "
+                                 "('Current Session', 'Current Tabs', 'Sessions/*') of the profiles "
+                                 "instead of exporting the history.")
+
+        parser.add_argument('--normalize-urls', dest='normalize_url_rules', nargs='*',
+                            type=str, choices=[r.value for r in UrlRule], required=False,
+                            help="Canonicalize URLs of history entries and merge duplicates: "
+                                 "Visit counts are summed, the latest visit time is kept. "
+                                 "Optionally, the rules to apply can be specified. Default rules: {}"
+                            .format(", ".join(r.value for r in DEFAULT_URL_RULES)))
+
+        parser.add_argument('--order-by', dest='order_by', type=str, required=False,
+                            help="Order exported history entries by these fields, "
+                                 "in the format of: <field>[:asc|desc],<field>[:asc|desc],... "
+                                 "Available fields: {}. Field '{}' is only available for cross profile queries. "
+                                 "Default value is: {}:desc"
+                            .format(", ".join(f.get_key() for f in CROSS_PROFILE_FIELDS), Field.PROFILE.get_key(),
+                                    Field.LAST_VISIT_TIME.get_key()))
+
+        parser.add_argument('--sort-memory-budget', dest='sort_memory_budget_mb', type=int,
+                            default=DEFAULT_MEMORY_BUDGET_MB, required=False,
+                            help="Memory budget in MB for buffering the exported entries of a profile. "
+                                 "Above this size, entries are written to temporary files as sorted runs, "
+                                 "which are merged for every export format. "
+                                 "Default value is: {}".format(DEFAULT_MEMORY_BUDGET_MB))
+
+        parser.add_argument('--partition-by', dest='partition_by', type=str, required=False,
+                            choices=[g.value for g in PartitionGranularity],
+                            help="Export history entries to one file per month or week of their last visit time, "
+                                 "into a stable export dir with a manifest of the partitions. "
+                                 "Subsequent runs only rewrite the partitions that changed.")
+
+        parser.add_argument('--partition-workers', dest='partition_workers', type=int, required=False,
+                            help="Number of worker threads writing partitions in parallel. "
+                                 "Default value is the number of CPUs.")
+
         args = parser.parse_args()
         print("Args: " + str(args))
         options = Options(args)
@@ -130,30 +201,32 @@ class DbResultFilter:
         self.date_range = date_range
         self.filter_match = filter_match
 
-    def _filter_by_date(self, row):
-        if self.date_range.from_date <= row.last_visit_time <= self.date_range.to_date:
+    def _filter_by_date(self, row, date_attr):
+        value = getattr(row, date_attr)
+        if value is not None and self.date_range.from_date <= value <= self.date_range.to_date:
             return True
         return False
 
-    def _filter_by_match(self, row):
-        if self.filter_match in row.url:
+    def _filter_by_match(self, row, match_attr):
+        value = getattr(row, match_attr)
+        if value is not None and self.filter_match in value:
             return True
         return False
 
-    def filter_rows(self, rows: List[ChromeHistoryEntry]):
-        def get_source():
-            return filtered_rows if filtered_rows else rows
-
-        filtered_rows = None
-        if self.date_range:
+    def filter_rows(self, rows: Iterable[ChromeHistoryEntry], date_attr="last_visit_time",
+                    match_attr="url") -> Iterable[ChromeHistoryEntry]:
+        """
+        Rows are filtered lazily, so they can be streamed from the DB to the exporter.
+        """
+        if self.date_range and date_attr:
             LOG.info("Filtering by date range: %s", self.date_range)
-            filtered_rows = list(filter(lambda row: self._filter_by_date(row), get_source()))
+            rows = filter(lambda row: self._filter_by_date(row, date_attr), rows)
 
-        if self.filter_match:
+        if self.filter_match and match_attr:
             LOG.info("Filtering entries for match by: %s", self.filter_match)
-            filtered_rows = list(filter(lambda row: self._filter_by_match(row), get_source()))
+            rows = filter(lambda row: self._filter_by_match(row, match_attr), rows)
 
-        return filtered_rows
+        return rows
 
 
 @auto_str
@@ -197,6 +270,18 @@ class Options:
         self.db_result_filter = DbResultFilter(self.date_range, self.filter_match)
         self.profile = args.profile
         self.is_list_db_tables = args.list_db_tables
+        self.cross_profile_query = CrossProfileQuery(args.cross_profile_query) if args.cross_profile_query else None
+        self.diff_profiles = args.diff_profiles
+        self.extract_sources = args.extract_sources
+        self.is_session_tabs = args.is_session_tabs
+        self.order_by = SortKey.parse(args.order_by, CROSS_PROFILE_FIELDS) if args.order_by else None
+        self.sort_memory_budget_mb = args.sort_memory_budget_mb
+        self.partition_by = PartitionGranularity(args.partition_by) if args.partition_by else None
+        self.partition_workers = args.partition_workers
+        self.url_canonicalizer = None
+        if args.normalize_url_rules is not None:
+            rules = [UrlRule(r) for r in args.normalize_url_rules] if args.normalize_url_rules else DEFAULT_URL_RULES
+            self.url_canonicalizer = UrlCanonicalizer(rules)
 
         self.export_filename_postfix = ""
         if not self.default_range:
@@ -209,6 +294,24 @@ class Options:
         if self.profile and not self.is_search_db_files:
             raise ValueError("Invalid configuration. "
                              "Search DB files (option: '--search-db-files' must be specified when profile is used!")
+        if (self.extract_sources or self.is_session_tabs) and not self.is_search_db_files:
+            raise ValueError("Invalid configuration. "
+                             "Search DB files (option: '--search-db-files' must be specified "
+                             "when extract sources or session tabs are used!")
+        if self.order_by and not self.cross_profile_query and Field.PROFILE in [k.field for k in self.order_by]:
+            raise ValueError("Invalid configuration. "
+                             "Ordering by field '{}' is only possible with cross profile queries (option: "
+                             "'--cross-profile-query')".format(Field.PROFILE.get_key()))
+        if self.cross_profile_query == CrossProfileQuery.DIFF and not self.diff_profiles:
+            raise ValueError("Invalid configuration. "
+                             "Option '--diff-profiles' must be specified for cross profile query: {}"
+                             .format(CrossProfileQuery.DIFF.value))
+        if self.partition_by and (self.extract_sources or self.is_session_tabs):
+            raise ValueError("Invalid configuration. "
+                             "Partitioned export (option: '--partition-by') is only possible for history entries!")
+        if self.partition_workers is not None and self.partition_workers < 1:
+            raise ValueError("Invalid configuration. "
+                             "Number of partition workers must be positive: {}".format(self.partition_workers))
 
     def __repr__(self):
         return str(self.__dict__)
@@ -218,6 +321,8 @@ class GChromeHistoryExport:
     def __init__(self, options):
         self.options = options
         self.available_profiles = None
+        self.profiles: List[ChromeProfile] = []
+        self.profile_keys_by_db_file: Dict[str, str] = {}
         self.setup_dirs()
 
     def setup_dirs(self):
@@ -237,6 +342,10 @@ class GChromeHistoryExport:
     def db_copies_dir(self):
         return ProjectUtils.get_output_child_dir('db_copies')
 
+    @property
+    def discovery_cache_file(self):
+        return os.path.join(self.project_out_root, DISCOVERY_CACHE_FILE_NAME)
+
     @staticmethod
     def get_profile_from_file_path(src_file, split_filename=True, to_lower=True) -> str:
         if split_filename:
@@ -247,15 +356,24 @@ class GChromeHistoryExport:
             prof = prof.lower()
         return prof.replace(" ", "")
 
-    def process_databases(self):
-        def _dst_filename_func(src_file, dest_dir):
-            # Profile directory name may contains spaces, e.g. "Profile 1"
-            profile: str = GChromeHistoryExport.get_profile_from_file_path(src_file)
-            file_name = os.path.basename(src_file)
-            return file_name + FILE_PROFILE_SEP + profile
+    @staticmethod
+    def get_profile_key_from_file_path(db_file) -> str:
+        """
+        Copies of DB files are named <file name>-<profile key>, otherwise the key is derived from the profile dir.
+        """
+        file_name = GChromeHistoryExport.get_profile_from_file_path(db_file, split_filename=False, to_lower=True)
+        if FILE_PROFILE_SEP in file_name:
+            return file_name.split(FILE_PROFILE_SEP)[1]
+        return GChromeHistoryExport.get_profile_from_file_path(db_file, split_filename=True, to_lower=True)
+
+    def _dst_filename_func(self, src_file, dest_dir):
+        profile: str = self.get_profile_key_of_db_file(src_file)
+        file_name = os.path.basename(src_file)
+        return file_name + FILE_PROFILE_SEP + profile
 
+    def process_databases(self):
         if self.options.is_search_db_files:
-            self.search_db_files(_dst_filename_func)
+            self.search_db_files(self._dst_filename_func)
 
         result = {}
         for db_file in self.options.db_files:
@@ -266,12 +384,131 @@ class GChromeHistoryExport:
             result[key] = filtered_rows
         return result
 
+    def process_databases_cross_profile(self):
+        if self.options.is_search_db_files:
+            self.search_db_files(self._dst_filename_func)
+
+        db_files_by_profile = {self.get_profile_key_of_db_file(db_file): db_file for db_file in self.options.db_files}
+        multi_db = MultiProfileChromeDb(db_files_by_profile)
+        date_range = None if self.options.default_range else self.options.date_range
+        query_kwargs = {
+            "from_date": date_range.from_date if date_range else None,
+            "to_date": date_range.to_date if date_range else None,
+            "filter_match": self.options.filter_match,
+            "order_by": self.options.order_by
+        }
+        query = self.options.cross_profile_query
+        LOG.info("Running cross profile query '%s' on profiles: %s", query.value, list(db_files_by_profile.keys()))
+        try:
+            if query == CrossProfileQuery.MERGED:
+                key = "all-profiles-merged"
+                rows = multi_db.query_merged(**query_kwargs)
+            elif query == CrossProfileQuery.DEDUPLICATED:
+                key = "all-profiles-dedup"
+                rows = multi_db.query_deduplicated(**query_kwargs)
+            else:
+                profile, other_profile = [self.resolve_profile_key(p) if self.profiles else p.lower()
+                                          for p in self.options.diff_profiles]
+                key = "{}-not-in-{}".format(profile, other_profile)
+                rows = multi_db.query_only_in(profile, other_profile, **query_kwargs)
+        except Exception:
+            multi_db.close()
+            raise
+        return {key: self._close_when_consumed(multi_db, self.normalize_urls(rows))}
+
+    @staticmethod
+    def _close_when_consumed(db, rows: Iterable) -> Iterator:
+        try:
+            yield from rows
+        finally:
+            db.close()
+
+    def process_extractor_sources(self):
+        """
+        Copies the DB files of the selected extractor sources of all profiles and extracts them in parallel.
+        :return: Dict of export name -> (source, filtered rows)
+        """
+        sources = get_sources(self.options.extract_sources)
+        msg = "Copying DB file.\n {} -> {}"
+        copied_db_files = {}
+        db_files = {}
+        for source in sources:
+            discovery = ProfileDiscovery(self.search_basedir, source.file_name, cache_file=self.discovery_cache_file)
+            for profile in discovery.discover():
+                if self.options.profile != ALL_PROFILES and not profile.matches(self.options.profile):
+                    continue
+                if profile.db_file not in copied_db_files:
+                    self.profile_keys_by_db_file[profile.db_file] = profile.key
+                    copied_db_files[profile.db_file] = FileUtils.copy_file_to_dir(
+                        profile.db_file, self.db_copies_dir, self._dst_filename_func, msg_template=msg)
+                db_files[(profile.key, source.name)] = copied_db_files[profile.db_file]
+        if not db_files:
+            raise ValueError("Cannot find any DB files of sources {} for profile '{}' under directory: {}"
+                             .format([s.name for s in sources], self.options.profile, self.search_basedir))
+
+        rows_by_key = ExtractorRunner().extract(db_files)
+        result = {}
+        for (profile, source_name), rows in rows_by_key.items():
+            source = EXTRACTOR_SOURCES[source_name]
+            # Rows with unset timestamps are only dropped if a date range is specified
+            date_attr = source.date_column if not self.options.default_range else None
+            filtered_rows = self.options.db_result_filter.filter_rows(rows, date_attr=date_attr,
+                                                                       match_attr=source.match_column)
+            result["{}-{}".format(profile, source_name)] = source, filtered_rows
+        return result
+
+    def process_session_files(self):
+        """
+        Parses the session files of all profiles.
+        :return: Dict of export name -> session navigations, every URL is listed once per profile
+        """
+        discovery = ProfileDiscovery(self.search_basedir, HISTORY_FILE_NAME, cache_file=self.discovery_cache_file)
+        result = {}
+        for profile in discovery.discover():
+            if self.options.profile != ALL_PROFILES and not profile.matches(self.options.profile):
+                continue
+            session_files = find_session_files(profile.profile_dir)
+            if not session_files:
+                LOG.info("No session files found for profile: %s", profile.display_name)
+                continue
+            navigations = iter_unique_navigations(session_files)
+            filtered = self.options.db_result_filter.filter_rows(navigations, date_attr=None, match_attr="url")
+            result["{}-{}".format(profile.key, SESSION_TABS_EXPORT_NAME)] = filtered
+        if not result:
+            raise ValueError("Cannot find any session files for profile '{}' under directory: {}"
+                             .format(self.options.profile, self.search_basedir))
+        return result
+
+    def get_profile_key_of_db_file(self, db_file):
+        if db_file in self.profile_keys_by_db_file:
+            return self.profile_keys_by_db_file[db_file]
+        return self.get_profile_key_from_file_path(db_file)
+
     def query_history_entries_from_db(self, chrome_db, db_file):
-        profile = self.get_profile_from_file_path(db_file, split_filename=False, to_lower=True)
-        key = profile.split(FILE_PROFILE_SEP)[1] if FILE_PROFILE_SEP in profile else profile
-        rows: List[ChromeHistoryEntry] = chrome_db.query_history_entries()
+        key = self.get_profile_key_of_db_file(db_file)
+        rows: Iterable[ChromeHistoryEntry] = chrome_db.query_history_entries(order_by=self.options.order_by)
         filtered_rows = self.options.db_result_filter.filter_rows(rows)
-        return key, filtered_rows
+        return key, self.normalize_urls(filtered_rows)
+
+    def get_effective_order_by(self) -> List[SortKey]:
+        """
+        :return: Sort keys of history entries, as specified or ordered by SQL by default
+        """
+        return self.options.order_by or [SortKey(Field.LAST_VISIT_TIME, Ordering.DESC)]
+
+    def get_export_order_by(self):
+        """
+        History entries are ordered by SQL, unless URL normalization merged them afterwards.
+        :return: Sort keys for DataConverter, None if the entries are already ordered
+        """
+        if self.options.url_canonicalizer:
+            return self.get_effective_order_by()
+        return None
+
+    def normalize_urls(self, rows: Iterable[ChromeHistoryEntry]) -> Iterable[ChromeHistoryEntry]:
+        if not self.options.url_canonicalizer:
+            return rows
+        return HistoryEntryDeduplicator(self.options.url_canonicalizer).deduplicate(rows)
 
     @staticmethod
     def print_db_tables(chrome_db, db_file):
@@ -290,52 +527,72 @@ class GChromeHistoryExport:
 
     def search_db_files(self, _dst_filename_func):
         """
-        EXAMPLE RESULTS
-        /Users/<someuser>/Library/Application Support/Google/Chrome//Profile 1/History
-        /Users/<someuser>/Library/Application Support/Google/Chrome//Default/History
-        /Users/<someuser>/Library/Application Support/Google/Chrome//Profile 3/History
-        /Users/<someuser>/Library/Application Support/Google/Chrome//System Profile/History
-        /Users/<someuser>/Library/Application Support/Google/Chrome//Guest Profile/History
+        Discovers the profiles from the 'Local State' file of the search basedir, falling back to a pruned walk
+        of the basedir, then copies the History DB of every profile to the DB copies dir.
+        EXAMPLE PROFILES (directory, display name)
+        Default (Person 1)
+        Profile 1 (Work)
+        Profile 3 (Person 2)
         :param _dst_filename_func:
         :return:
         """
-        found_db_files = FileUtils.search_files(self.search_basedir, HISTORY_FILE_NAME)
-        self.available_profiles = [self.get_profile_from_file_path(file, to_lower=True)
-                                   for file in found_db_files]
-        if not found_db_files:
+        discovery = ProfileDiscovery(self.search_basedir, HISTORY_FILE_NAME, cache_file=self.discovery_cache_file)
+        self.profiles = discovery.discover()
+        if not self.profiles:
             raise ValueError("Cannot find any {} under directory: {}"
                              .format(GOOGLE_CHROME_HIST_DB_TEXT, self.search_basedir))
-        LOG.info("Found DB files: \n%s", "\n".join(found_db_files))
-        if self.options.profile != ALL_PROFILES and self.options.profile.lower() not in self.available_profiles:
-            raise ValueError("No {} found for profile: {}. "
-                             "Available profiles: {}"
-                             .format(GOOGLE_CHROME_HIST_DB_TEXT, self.options.profile, self.available_profiles))
+        self.available_profiles = [p.key for p in self.profiles]
+        LOG.info("Found DB files: \n%s",
+                 "\n".join("{} (profile: {})".format(p.db_file, p.display_name) for p in self.profiles))
+        if self.options.profile != ALL_PROFILES:
+            self.options.profile = self.resolve_profile_key(self.options.profile)
 
         # Make a copy of each DB file as they might be locked by Chrome if running
         msg = "Copying {}.".format(GOOGLE_CHROME_HIST_DB_TEXT) + "\n {} -> {}"
-        copied_db_files = [FileUtils.copy_file_to_dir(db, self.db_copies_dir, _dst_filename_func, msg_template=msg)
-                           for db in found_db_files]
+        for profile in self.profiles:
+            self.profile_keys_by_db_file[profile.db_file] = profile.key
+            copied_db_file = FileUtils.copy_file_to_dir(profile.db_file, self.db_copies_dir, _dst_filename_func,
+                                                        msg_template=msg)
+            self.profile_keys_by_db_file[copied_db_file] = profile.key
+            self.options.db_files.append(copied_db_file)
         file_sizes = FileUtils.get_formatted_file_sizes_in_dir(self.db_copies_dir,
                                                                since=DateUtils.get_current_time_minus(minutes=1))
         LOG.info("Sizes of %s:\n%s", GOOGLE_CHROME_HIST_DB_TEXT, file_sizes)
-        self.options.db_files.extend(copied_db_files)
+
+    def resolve_profile_key(self, profile: str) -> str:
+        for p in self.profiles:
+            if p.matches(profile):
+                return p.key
+        available = ["{} ({})".format(p.key, p.display_name) for p in self.profiles]
+        raise ValueError("No {} found for profile: {}. "
+                         "Available profiles: {}"
+                         .format(GOOGLE_CHROME_HIST_DB_TEXT, profile, available))
 
     def create_new_export_dir(self):
         dt_string = DateUtils.now_formatted("%Y%m%d_%H%M%S")
         dirname = FileUtils.ensure_dir_created(os.path.join(self.exports_dir, f"{EXPORTED_DIR_NAME_PREFIX}-{dt_string}"))
         return dirname
 
-    def get_exported_filename(self, export_dir, profile, ext_enum):
+    def create_partitioned_export_dir(self):
+        dirname = "{}-{}{}".format(PARTITIONED_DIR_NAME_PREFIX, self.options.partition_by.value,
+                                   self.options.export_filename_postfix)
+        return FileUtils.ensure_dir_created(os.path.join(self.exports_dir, dirname))
+
+    def get_exported_filename(self, export_dir, profile, ext_enum, postfix=None):
         filename = export_dir + os.sep + profile
-        if self.options.export_filename_postfix != "":
-            filename += self.options.export_filename_postfix
+        postfix = postfix if postfix is not None else self.options.export_filename_postfix
+        if postfix != "":
+            filename += postfix
         filename += "." + ext_enum.value
         return filename
 
-    def export(self, export_dir, converter, profile):
-        html_filename = self.get_exported_filename(export_dir, profile, Extension.HTML)
-        csv_filename = self.get_exported_filename(export_dir, profile, Extension.CSV)
-        text_filename = self.get_exported_filename(export_dir, profile, Extension.TEXT)
+    def get_export_targets(self, export_dir, name, postfix=None):
+        """
+        Returns the export functions and file names for the export mode, as pairs
+        """
+        html_filename = self.get_exported_filename(export_dir, name, Extension.HTML, postfix=postfix)
+        csv_filename = self.get_exported_filename(export_dir, name, Extension.CSV, postfix=postfix)
+        text_filename = self.get_exported_filename(export_dir, name, Extension.TEXT, postfix=postfix)
 
         export_filenames_dict = {
             ExportMode.HTML: [html_filename],
@@ -354,18 +611,20 @@ class GChromeHistoryExport:
             ]
         }
         export_mode = self.options.export_mode
-        export_funcs = export_funcs_dict[export_mode]
-        export_filenames = export_filenames_dict[export_mode]
-        for func, filename in zip(export_funcs, export_filenames):
-            ext_enum = Extension(FileUtils.get_file_extension(filename))
-            LOG.info("Exporting DB to %s file", ext_enum.name)
-            func(converter, filename)
-
-    def export_by_profile(self, export_dir, entries_by_db_file, profile):
-        src_data = entries_by_db_file[profile]
-        all_fields = [f for f in Field]
+        return list(zip(export_funcs_dict[export_mode], export_filenames_dict[export_mode]))
+
+    def export(self, export_dir, converter, profile):
+        try:
+            for func, filename in self.get_export_targets(export_dir, profile):
+                ext_enum = Extension(FileUtils.get_file_extension(filename))
+                LOG.info("Exporting DB to %s file", ext_enum.name)
+                func(converter, filename)
+        finally:
+            converter.close()
+
+    def create_truncate_config(self, fields):
         truncate_config = TruncateConfig()
-        for f in all_fields:
+        for f in fields:
             modes = [ExportMode.TEXT, ExportMode.HTML]
             for mode in modes:
                 if not self.options.truncate or f.get_type() in {FieldType.DATETIME}:
@@ -375,15 +634,61 @@ class GChromeHistoryExport:
 
             # Never truncate in CSV files
             truncate_config.add_field(f, False, ExportMode.CSV)
-        converter = DataConverter(src_data,
-                                  [Field.TITLE, Field.URL, Field.LAST_VISIT_TIME, Field.VISIT_COUNT],
-                                  RowStats(all_fields, track_unique=[Field.URL]),
-                                  truncate_config,
-                                  Field.LAST_VISIT_TIME,
-                                  Ordering.DESC,
-                                  add_row_numbers=True)
+        return truncate_config
+
+    def create_converter(self, src_data, fields, order_by, track_unique):
+        return DataConverter(src_data,
+                             list(fields),
+                             RowStats(fields, track_unique=track_unique),
+                             self.create_truncate_config(fields),
+                             order_by,
+                             Ordering.DESC,
+                             add_row_numbers=True,
+                             sort_memory_budget_mb=self.options.sort_memory_budget_mb)
+
+    def export_by_profile(self, export_dir, entries_by_db_file, profile, fields=None,
+                          order_by=Field.LAST_VISIT_TIME, track_unique=None):
+        src_data = entries_by_db_file[profile]
+        fields = fields if fields else HISTORY_FIELDS
+        track_unique = track_unique if track_unique is not None else [Field.URL]
+        converter = self.create_converter(src_data, fields, order_by, track_unique)
         self.export(export_dir, converter, profile)
 
+    def get_partition_settings(self, fields, order_by: List[SortKey]) -> str:
+        """
+        Partitions written with different settings are rewritten, even if their rows are the same.
+        The fingerprints of partitions don't depend on the order of rows, so the ordering is part of the settings.
+        The date range is not part of the settings, as it is part of the name of the export dir.
+        """
+        order_by_str = ",".join("{}:{}".format(k.field.get_key(), k.ordering.value) for k in order_by)
+        rules = sorted(r.value for r in self.options.url_canonicalizer.rules) if self.options.url_canonicalizer else []
+        return "fields={};order_by={};truncate={};normalize_urls={}".format(
+            ",".join(f.get_key() for f in fields), order_by_str, self.options.truncate, ",".join(rules))
+
+    def export_partitioned(self, export_dir, entries_by_key, keys, fields=None):
+        fields = fields if fields else HISTORY_FIELDS
+        # Rows are regrouped by partition, so every partition is ordered by the converter, even if SQL ordered the rows
+        order_by = self.get_effective_order_by()
+        partitioned_exporter = PartitionedExporter(export_dir, self.options.partition_by,
+                                                   self.get_partition_settings(fields, order_by),
+                                                   max_workers=self.options.partition_workers,
+                                                   memory_budget_mb=self.options.sort_memory_budget_mb)
+        for key in keys:
+            LOG.info("Exporting partitions of %s by %s: %s", GOOGLE_CHROME_HIST_DB_TEXT,
+                     self.options.partition_by.value, key)
+            partitioned_exporter.export(
+                key, entries_by_key[key], Field.LAST_VISIT_TIME, fields,
+                lambda rows: self.create_converter(rows, fields, order_by, [Field.URL]),
+                lambda name: self.get_export_targets(export_dir, name, postfix=""))
+
+    def export_extracted_source(self, export_dir, extracted, name):
+        source, rows = extracted[name]
+        url_columns = [c for c in source.columns if c.get_type() == FieldType.URL]
+        self.export_by_profile(export_dir, {name: rows}, name,
+                               fields=source.columns,
+                               order_by=source.get_column(source.order_by) if source.order_by else None,
+                               track_unique=url_columns[:1])
+
 
 def main():
     start_time = time.time()
@@ -395,19 +700,58 @@ def main():
     # Initialize logging
     Setup.init_logger(exporter.log_dir, console_debug=options.verbose)
 
+    if options.is_session_tabs:
+        navigations_by_key = exporter.process_session_files()
+        export_dir = exporter.create_new_export_dir()
+        for key in navigations_by_key:
+            LOG.info("Exporting session tabs: %s", key)
+            exporter.export_by_profile(export_dir, navigations_by_key, key, fields=SESSION_TABS_FIELDS, order_by=None)
+        LOG.info("Execution of script took %d seconds", time.time() - start_time)
+        return
+
+    if options.extract_sources:
+        extracted = exporter.process_extractor_sources()
+        export_dir = exporter.create_new_export_dir()
+        for name in extracted:
+            LOG.info("Exporting extracted source: %s", name)
+            exporter.export_extracted_source(export_dir, extracted, name)
+        LOG.info("Execution of script took %d seconds", time.time() - start_time)
+        return
+
+    if options.cross_profile_query:
+        entries_by_key = exporter.process_databases_cross_profile()
+        if options.partition_by:
+            exporter.export_partitioned(exporter.create_partitioned_export_dir(), entries_by_key,
+                                        list(entries_by_key.keys()), fields=CROSS_PROFILE_FIELDS)
+            LOG.info("Execution of script took %d seconds", time.time() - start_time)
+            return
+        export_dir = exporter.create_new_export_dir()
+        for key in entries_by_key:
+            LOG.info("Exporting result of cross profile query: %s", key)
+            exporter.export_by_profile(export_dir, entries_by_key, key, fields=CROSS_PROFILE_FIELDS,
+                                       order_by=exporter.get_export_order_by())
+        LOG.info("Execution of script took %d seconds", time.time() - start_time)
+        return
+
     # Start exporting
     entries_by_db_file = exporter.process_databases()
 
     profile = exporter.options.profile
+    if options.partition_by:
+        profiles = exporter.available_profiles if profile == ALL_PROFILES else [profile]
+        exporter.export_partitioned(exporter.create_partitioned_export_dir(), entries_by_db_file, profiles)
+        LOG.info("Execution of script took %d seconds", time.time() - start_time)
+        return
+
     export_dir = exporter.create_new_export_dir()
     if profile == ALL_PROFILES:
         LOG.info("Exporting all %s...", GOOGLE_CHROME_HIST_DB_TEXT_PLURAL)
         for profile in exporter.available_profiles:
-            exporter.export_by_profile(export_dir, entries_by_db_file, profile)
+            exporter.export_by_profile(export_dir, entries_by_db_file, profile, order_by=exporter.get_export_order_by())
     else:
         # Single profile
         LOG.info("Exporting %s for single profile: %s", GOOGLE_CHROME_HIST_DB_TEXT, profile)
-        exporter.export_by_profile(export_dir, entries_by_db_file, profile)
+        exporter.export_by_profile(export_dir, entries_by_db_file, profile, order_by=exporter.get_export_order_by())
 
     LOG.info("Execution of script took %d seconds", time.time() - start_time)
 
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from pythoncommons.file_utils import FileUtils
+from pythoncommons.project_utils import ProjectUtils
+
+from googlechrometoolkit.constants import GOOGLE_CHROME_HIST_DB_TEXT
+from googlechrometoolkit.profiles import ProfileDiscovery
+from googlechrometoolkit.server import DEFAULT_CACHE_SIZE, DEFAULT_HOST, DEFAULT_POOL_SIZE, DEFAULT_PORT, \
+    DbSnapshot, HistoryQueryServer, HistoryQueryService
+from main import ALL_PROFILES, DEFAULT_GOOGLE_CHROME_DIR, DISCOVERY_CACHE_FILE_NAME, GChromeHistoryExport, \
+    HISTORY_FILE_NAME, PROJECT_NAME, Setup
+
+__author__ = 'Szilard Nemeth'
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve read-only history queries over HTTP/JSON on localhost")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest='verbose', default=None, required=False,
+                        help='More verbose log')
+
+    parser.add_argument('-f', '--db-files', dest="db_files", type=FileUtils.ensure_file_exists_and_readable,
+                        nargs='+', required=False,
+                        help="Serve these {} instead of searching them".format(GOOGLE_CHROME_HIST_DB_TEXT))
+
+    parser.add_argument('-sb', '--search-basedir',
+                        dest='search_basedir', default=DEFAULT_GOOGLE_CHROME_DIR,
+                        required=False,
+                        help='Basedir where this script looks for Google Chrome history DB files.')
+
+    parser.add_argument('-p', '--profile', default=ALL_PROFILES,
+                        dest='profile',
+                        type=str, required=False,
+                        help="Which profile to serve. Either the profile directory name or the display name "
+                             "of the profile can be specified. "
+                             "Default value is: '{}', which means serve all profiles.".format(ALL_PROFILES))
+
+    parser.add_argument('--host', dest='host', default=DEFAULT_HOST, required=False,
+                        help="Host to bind to. Default value is: {}".format(DEFAULT_HOST))
+
+    parser.add_argument('--port', dest='port', type=int, default=DEFAULT_PORT, required=False,
+                        help="Port to bind to. Default value is: {}".format(DEFAULT_PORT))
+
+    parser.add_argument('--pool-size', dest='pool_size', type=int, default=DEFAULT_POOL_SIZE, required=False,
+                        help="Number of worker threads and read-only DB connections per profile. "
+                             "Default value is: {}".format(DEFAULT_POOL_SIZE))
+
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=DEFAULT_CACHE_SIZE, required=False,
+                        help="Number of cached query results. Default value is: {}".format(DEFAULT_CACHE_SIZE))
+    return parser.parse_args()
+
+
+def find_db_files_by_profile(args, project_out_root):
+    if args.db_files:
+        result = {}
+        for db_file in args.db_files:
+            key = GChromeHistoryExport.get_profile_key_from_file_path(db_file)
+            if key in result:
+                raise ValueError("Multiple {} for profile '{}': {}, {}"
+                                 .format(GOOGLE_CHROME_HIST_DB_TEXT, key, result[key], db_file))
+            result[key] = db_file
+        return result
+
+    discovery = ProfileDiscovery(args.search_basedir, HISTORY_FILE_NAME,
+                                 cache_file=os.path.join(project_out_root, DISCOVERY_CACHE_FILE_NAME))
+    profiles = [p for p in discovery.discover() if args.profile == ALL_PROFILES or p.matches(args.profile)]
+    if not profiles:
+        raise ValueError("Cannot find any {} for profile '{}' under directory: {}"
+                         .format(GOOGLE_CHROME_HIST_DB_TEXT, args.profile, args.search_basedir))
+    return {p.key: p.db_file for p in profiles}
+
+
+async def serve(server: HistoryQueryServer):
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def main():
+    start_time = time.time()
+    args = parse_args()
+    project_out_root = ProjectUtils.get_output_basedir(PROJECT_NAME)
+    Setup.init_logger(ProjectUtils.get_output_child_dir('logs'), console_debug=args.verbose)
+
+    db_files_by_profile = find_db_files_by_profile(args, project_out_root)
+    snapshots_dir = ProjectUtils.get_output_child_dir('db_snapshots')
+    snapshots = {profile: DbSnapshot(profile, db_file, snapshots_dir, pool_size=args.pool_size)
+                 for profile, db_file in db_files_by_profile.items()}
+    service = HistoryQueryService(snapshots, cache_size=args.cache_size)
+    server = HistoryQueryServer(service, host=args.host, port=args.port, max_workers=args.pool_size)
+    try:
+        asyncio.run(serve(server))
+    except KeyboardInterrupt:
+        LOG.info("Stopping server")
+    finally:
+        service.close()
+    LOG.info("Server was running for %d seconds", time.time() - start_time)
+
+
+if __name__ == '__main__':
+    main()
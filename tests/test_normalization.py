@@ -0,0 +1,41 @@
+import datetime
+import unittest
+
+from googlechrometoolkit.database import ChromeHistoryEntry
+from googlechrometoolkit.normalization import HistoryEntryDeduplicator, UrlCanonicalizer, UrlRule
+
+
+class UrlCanonicalizerTest(unittest.TestCase):
+    def test_default_rules(self):
+        canonicalizer = UrlCanonicalizer()
+        self.assertEqual("https://ex.com/a?q=1",
+                         canonicalizer.canonicalize("http://EX.com/a/?utm_source=x&q=1&fbclid=y#top"))
+        self.assertEqual("chrome://settings/", canonicalizer.canonicalize("chrome://settings/"))
+
+    def test_unify_scheme_drops_default_ports(self):
+        canonicalizer = UrlCanonicalizer([UrlRule.UNIFY_SCHEME])
+        self.assertEqual("https://ex.com/", canonicalizer.canonicalize("https://ex.com:443/"))
+        self.assertEqual("https://ex.com/", canonicalizer.canonicalize("http://ex.com:80/"))
+        self.assertEqual("https://[::1]/", canonicalizer.canonicalize("http://[::1]:443/"))
+        self.assertEqual("https://ex.com:8443/", canonicalizer.canonicalize("https://ex.com:8443/"))
+        self.assertEqual("https://ex.com:443/", UrlCanonicalizer([]).canonicalize("https://ex.com:443/"))
+
+    def test_malformed_url_is_kept(self):
+        self.assertEqual("http://[::1", UrlCanonicalizer().canonicalize("http://[::1"))
+
+
+class HistoryEntryDeduplicatorTest(unittest.TestCase):
+    def test_deduplicate(self):
+        entries = [
+            ChromeHistoryEntry("A", "https://ex.com/", datetime.datetime(2020, 1, 1), 1, profile="default"),
+            ChromeHistoryEntry("B", "http://[::1", datetime.datetime(2020, 1, 2), 1, profile="default"),
+            ChromeHistoryEntry("A2", "http://ex.com:80/#x", datetime.datetime(2020, 1, 3), 2, profile="profile1"),
+        ]
+        result = list(HistoryEntryDeduplicator(UrlCanonicalizer()).deduplicate(entries))
+        self.assertEqual([("A2", "http://ex.com:80/#x", datetime.datetime(2020, 1, 3), 3, "default,profile1"),
+                          ("B", "http://[::1", datetime.datetime(2020, 1, 2), 1, "default")],
+                         [(e.title, e.url, e.last_visit_time, e.visit_count, e.profile) for e in result])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import csv
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from googlechrometoolkit.database import ChromeHistoryEntry
+from googlechrometoolkit.exporters import DataConverter, ExportMode, Field, ResultPrinter, RowStats, TruncateConfig
+from googlechrometoolkit.partitioning import MANIFEST_FILE_NAME, PartitionedExporter, PartitionGranularity
+from googlechrometoolkit.sorting import Ordering, SortKey
+
+PROFILE = "default"
+FIELDS = [Field.TITLE, Field.URL, Field.LAST_VISIT_TIME, Field.VISIT_COUNT]
+SETTINGS = "fields=title,url,last_visit_time,visit_count;order_by=last_visit_time:DESC"
+
+
+def entry(title, month, day, visit_count=1):
+    return ChromeHistoryEntry(title, "https://{}.com/".format(title.lower()),
+                              datetime.datetime(2020, month, day), visit_count)
+
+
+def create_entries():
+    return [entry("A", 1, 5), entry("B", 1, 20), entry("C", 2, 3), entry("D", 2, 14), entry("E", 3, 1),
+            ChromeHistoryEntry("Undated", "https://undated.com/", None, 1)]
+
+
+def create_truncate_config():
+    truncate_config = TruncateConfig()
+    for f in FIELDS:
+        for mode in ExportMode:
+            truncate_config.add_field(f, False, mode)
+    return truncate_config
+
+
+class PartitionedExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.export_dir = tempfile.mkdtemp()
+        self.written = []
+        self.failing_partition = None
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir)
+
+    def write_csv(self, converter, filename):
+        if self.failing_partition and self.failing_partition in filename:
+            raise OSError("No space left on device")
+        self.written.append(os.path.basename(filename))
+        ResultPrinter.print_table_csv(converter, filename)
+
+    def export(self, entries, settings=SETTINGS, sort_keys=None):
+        self.written = []
+        sort_keys = sort_keys if sort_keys else [SortKey(Field.LAST_VISIT_TIME, Ordering.DESC)]
+        exporter = PartitionedExporter(self.export_dir, PartitionGranularity.MONTH, settings, max_workers=2,
+                                       memory_budget_mb=0.001)
+        exporter.export(PROFILE, iter(entries), Field.LAST_VISIT_TIME, FIELDS,
+                        lambda rows: DataConverter(rows, list(FIELDS), RowStats(FIELDS), create_truncate_config(),
+                                                   sort_keys, Ordering.DESC, sort_memory_budget_mb=0.001),
+                        lambda name: [(self.write_csv, os.path.join(self.export_dir, name + ".csv"))])
+        return sorted(self.written)
+
+    def read_titles(self, file_name):
+        with open(os.path.join(self.export_dir, file_name), newline="", encoding="utf-8") as f:
+            return [row[0] for row in list(csv.reader(f))[1:]]
+
+    def read_manifest(self):
+        with open(os.path.join(self.export_dir, MANIFEST_FILE_NAME), encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_first_run_writes_all_partitions(self):
+        written = self.export(create_entries())
+        self.assertEqual(["default-2020-01.csv", "default-2020-02.csv", "default-2020-03.csv", "default-undated.csv"],
+                         written)
+        self.assertEqual(["B", "A"], self.read_titles("default-2020-01.csv"))
+        self.assertEqual(["Undated"], self.read_titles("default-undated.csv"))
+
+        partitions = self.read_manifest()["profiles"][PROFILE]
+        self.assertEqual(["2020-01", "2020-02", "2020-03", "undated"], sorted(partitions))
+        self.assertEqual(2, partitions["2020-02"]["row_count"])
+        self.assertEqual("2020-02-03T00:00:00", partitions["2020-02"]["min_time"])
+        self.assertEqual("2020-02-14T00:00:00", partitions["2020-02"]["max_time"])
+
+    def test_rerun_without_changes_writes_nothing(self):
+        self.export(create_entries())
+        manifest = self.read_manifest()
+        # The order of rows doesn't matter
+        self.assertEqual([], self.export(list(reversed(create_entries()))))
+        self.assertEqual(manifest, self.read_manifest())
+
+    def test_only_changed_partition_is_rewritten(self):
+        self.export(create_entries())
+        entries = create_entries()
+        entries[3].visit_count = 2
+        entries.append(entry("F", 2, 28))
+        self.assertEqual(["default-2020-02.csv"], self.export(entries))
+        self.assertEqual(["F", "D", "C"], self.read_titles("default-2020-02.csv"))
+        self.assertEqual(3, self.read_manifest()["profiles"][PROFILE]["2020-02"]["row_count"])
+
+    def test_files_of_removed_partition_are_deleted(self):
+        self.export(create_entries())
+        entries = [e for e in create_entries() if e.last_visit_time is None or e.last_visit_time.month != 3]
+        self.assertEqual([], self.export(entries))
+        self.assertFalse(os.path.exists(os.path.join(self.export_dir, "default-2020-03.csv")))
+        self.assertNotIn("2020-03", self.read_manifest()["profiles"][PROFILE])
+
+    def test_changed_settings_rewrite_all_partitions(self):
+        self.export(create_entries())
+        sort_keys = [SortKey(Field.TITLE, Ordering.ASC)]
+        written = self.export(create_entries(), settings=SETTINGS.replace("last_visit_time:DESC", "title:ASC"),
+                              sort_keys=sort_keys)
+        self.assertEqual(4, len(written))
+        self.assertEqual(["A", "B"], self.read_titles("default-2020-01.csv"))
+
+    def test_failed_partition_keeps_other_partitions_and_stale_files(self):
+        self.export(create_entries())
+
+        entries = [e for e in create_entries() if e.last_visit_time is None or e.last_visit_time.month != 3]
+        entries[0].visit_count = 2
+        entries[2].visit_count = 2
+        self.failing_partition = "2020-02"
+        with self.assertRaises(OSError):
+            self.export(entries)
+        self.assertEqual(["default-2020-01.csv"], self.written)
+
+        partitions = self.read_manifest()["profiles"][PROFILE]
+        # The stale partition is only removed by a complete run
+        self.assertTrue(os.path.exists(os.path.join(self.export_dir, "default-2020-03.csv")))
+        self.assertIsNone(partitions["2020-02"]["fingerprint"])
+        self.assertIsNone(partitions["2020-03"]["fingerprint"])
+        self.failing_partition = None
+        self.assertEqual(["default-2020-02.csv"], self.export(entries))
+        self.assertFalse(os.path.exists(os.path.join(self.export_dir, "default-2020-03.csv")))
+
+
+if __name__ == '__main__':
+    unittest.main()
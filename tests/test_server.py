@@ -0,0 +1,157 @@
+import asyncio
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+from unittest import mock
+
+from googlechrometoolkit.database import _convert_to_chrome_time
+from googlechrometoolkit.server import DbSnapshot, HistoryQuery, HistoryQueryServer, HistoryQueryService
+
+PROFILE_1 = "default"
+PROFILE_2 = "profile1"
+
+
+def create_history_db(db_file, entries):
+    conn = sqlite3.connect(db_file)
+    conn.execute("CREATE TABLE urls (id INTEGER PRIMARY KEY, url LONGVARCHAR, title LONGVARCHAR, "
+                 "visit_count INTEGER DEFAULT 0 NOT NULL, last_visit_time INTEGER NOT NULL)")
+    insert_entries(conn, entries)
+    conn.close()
+
+
+def insert_entries(conn, entries):
+    conn.executemany("INSERT INTO urls (url, title, visit_count, last_visit_time) VALUES (?, ?, ?, ?)",
+                     [(url, title, 1, _convert_to_chrome_time(dt)) for url, title, dt in entries])
+    conn.commit()
+
+
+class HistoryQueryServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshots_dir = os.path.join(self.tmp_dir, "snapshots")
+        os.mkdir(self.snapshots_dir)
+        self.db_files = {PROFILE_1: os.path.join(self.tmp_dir, "History-" + PROFILE_1),
+                         PROFILE_2: os.path.join(self.tmp_dir, "History-" + PROFILE_2)}
+        # Visit times of the profiles are interleaved, so pages contain entries of both profiles
+        create_history_db(self.db_files[PROFILE_1],
+                          [("https://a{}.com/".format(i), "A{}".format(i), datetime.datetime(2020, 9, 1 + 2 * i))
+                           for i in range(5)])
+        create_history_db(self.db_files[PROFILE_2],
+                          [("https://b{}.com/".format(i), "B{}".format(i), datetime.datetime(2020, 9, 2 + 2 * i))
+                           for i in range(5)])
+
+        snapshots = {profile: DbSnapshot(profile, db_file, self.snapshots_dir, pool_size=2)
+                     for profile, db_file in self.db_files.items()}
+        self.service = HistoryQueryService(snapshots, cache_size=16)
+        self.server = HistoryQueryServer(self.service, port=0, max_workers=2)
+        self.loop = asyncio.new_event_loop()
+        self.port = self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+        self.service.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def get(self, path):
+        try:
+            with urllib.request.urlopen("http://127.0.0.1:{}{}".format(self.port, path), timeout=10) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    def test_health(self):
+        self.assertEqual((200, {"status": "ok"}), self.get("/health"))
+
+    def test_pagination_across_profiles(self):
+        titles = []
+        for offset in range(0, 10, 3):
+            status, body = self.get("/history?limit=3&offset={}".format(offset))
+            self.assertEqual(200, status)
+            self.assertEqual(10, body["total"])
+            self.assertEqual([PROFILE_1, PROFILE_2], body["profiles"])
+            titles.extend(e["title"] for e in body["entries"])
+        expected = ["B4", "A4", "B3", "A3", "B2", "A2", "B1", "A1", "B0", "A0"]
+        self.assertEqual(expected, titles)
+
+    def test_single_profile_with_filters(self):
+        status, body = self.get("/history?profile={}&from=2020-09-04&match=a3".format(PROFILE_1))
+        self.assertEqual(200, status)
+        self.assertEqual(1, body["total"])
+        self.assertEqual(["https://a3.com/"], [e["url"] for e in body["entries"]])
+
+    def test_date_with_utc_offset(self):
+        # 2020-09-07T01:00:00+02:00 is 2020-09-06T23:00:00 UTC: Entries A3 (09-07) and A4 (09-09) are returned
+        from_date = urllib.parse.quote("2020-09-07T01:00:00+02:00")
+        status, body = self.get("/history?profile={}&from={}".format(PROFILE_1, from_date))
+        self.assertEqual(200, status)
+        self.assertEqual(["A4", "A3"], [e["title"] for e in body["entries"]])
+
+    def test_invalid_date(self):
+        status, body = self.get("/history?from=2020-13-01")
+        self.assertEqual(400, status)
+        self.assertIn("Invalid date", body["error"])
+
+    def test_unknown_profile(self):
+        status, body = self.get("/history?profile=unknown")
+        self.assertEqual(404, status)
+        self.assertIn("unknown", body["error"])
+
+    def test_bad_limit(self):
+        for limit in ["abc", "0", "100000"]:
+            status, body = self.get("/history?limit={}".format(limit))
+            self.assertEqual(400, status, msg="limit={}".format(limit))
+            self.assertIn("limit", body["error"])
+
+    def test_cache_invalidated_after_source_db_changes(self):
+        path = "/history?profile={}&limit=1".format(PROFILE_1)
+        status, body = self.get(path)
+        self.assertEqual(200, status)
+        self.assertEqual("A4", body["entries"][0]["title"])
+        self.get(path)
+        self.assertEqual(1, self.service.cache.hits)
+
+        db_file = self.db_files[PROFILE_1]
+        conn = sqlite3.connect(db_file)
+        insert_entries(conn, [("https://new.com/", "New", datetime.datetime(2021, 1, 1))])
+        conn.close()
+        # Make sure the mtime changes even on file systems with a coarse timestamp resolution
+        st = os.stat(db_file)
+        os.utime(db_file, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+
+        status, body = self.get(path)
+        self.assertEqual(200, status)
+        self.assertEqual(6, body["total"])
+        self.assertEqual("New", body["entries"][0]["title"])
+        self.assertEqual(1, self.service.cache.hits)
+        # Only the profile was queried, its old snapshot is removed
+        self.assertEqual(1, len(os.listdir(self.snapshots_dir)))
+
+    def test_query_retried_if_snapshot_refreshed_during_query(self):
+        query = HistoryQuery((PROFILE_1,), limit=1)
+        stale = self.service._acquire_snapshots(query.profiles)
+        # Refreshing the snapshot closes the pool returned above
+        snapshot = self.service.snapshots[PROFILE_1]
+        with snapshot._lock:
+            snapshot._refresh("changed")
+
+        acquire = self.service._acquire_snapshots
+        with mock.patch.object(self.service, "_acquire_snapshots", side_effect=[stale, acquire(query.profiles)]):
+            result = self.service.query(query)
+        self.assertEqual(5, result["total"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from googlechrometoolkit.sessions import SessionFileParser, SessionFileType, iter_unique_navigations
+
+
+def pad(b):
+    return b + b"\0" * (-len(b) % 4)
+
+
+def navigation_command(command_id, tab_id, index, url, title):
+    url_bytes = url.encode("utf-8")
+    payload = (struct.pack("<ii", tab_id, index)
+               + struct.pack("<i", len(url_bytes)) + pad(url_bytes)
+               + struct.pack("<i", len(title)) + pad(title.encode("utf-16-le")))
+    return command(command_id, struct.pack("<I", len(payload)) + payload)
+
+
+def command(command_id, payload):
+    return struct.pack("<H", 1 + len(payload)) + bytes([command_id]) + payload
+
+
+def snss(commands, version=3, signature=b"SNSS"):
+    return struct.pack("<4si", signature, version) + b"".join(commands)
+
+
+NAVIGATION = SessionFileType.SESSION.value
+
+
+class SessionFileParserTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, file_name, data):
+        path = os.path.join(self.tmp_dir, file_name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_parse_session_file(self):
+        data = snss([
+            navigation_command(NAVIGATION, 1, 0, "https://a.com/", "A"),
+            # Other commands are skipped, even if their payload looks like a navigation
+            command(NAVIGATION + 1, b"\x01\x02\x03"),
+            navigation_command(NAVIGATION + 1, 9, 9, "https://skipped.com/", "Skipped"),
+            navigation_command(NAVIGATION, 2, 1, "https://b.com/page", "B é"),
+            navigation_command(NAVIGATION, 3, 0, "https://a.com/", "A again"),
+        ])
+        # Truncated command at the end of the file
+        data += navigation_command(NAVIGATION, 4, 0, "https://c.com/", "C")[:-3]
+        path = self.write_file("Session_1", data)
+
+        navigations = list(SessionFileParser(path).iter_navigations())
+        self.assertEqual([(1, 0, "https://a.com/", "A"), (2, 1, "https://b.com/page", "B é"),
+                          (3, 0, "https://a.com/", "A again")],
+                         [(n.tab_id, n.index, n.url, n.title) for n in navigations])
+
+        seen_urls = set()
+        navigations = list(SessionFileParser(path).iter_navigations(seen_urls))
+        self.assertEqual(["https://a.com/", "https://b.com/page"], [n.url for n in navigations])
+        self.assertEqual({b"https://a.com/", b"https://b.com/page"}, seen_urls)
+
+    def test_tabs_file_uses_its_own_command_id(self):
+        path = self.write_file("Tabs_1", snss([
+            navigation_command(SessionFileType.TABS.value, 1, 0, "https://tab.com/", "Tab"),
+            navigation_command(SessionFileType.SESSION.value, 2, 0, "https://session.com/", "Session"),
+        ]))
+        self.assertEqual(["https://tab.com/"], [n.url for n in SessionFileParser(path).iter_navigations()])
+
+    def test_unique_navigations_skip_unreadable_files(self):
+        files = [
+            self.write_file("Session_1", snss([
+                navigation_command(NAVIGATION, 1, 0, "chrome://newtab/", "New Tab"),
+                navigation_command(NAVIGATION, 1, 1, "https://a.com/", "A"),
+            ])),
+            self.write_file("Session_2", snss([navigation_command(NAVIGATION, 1, 0, "https://x.com/", "X")],
+                                              version=2)),
+            self.write_file("Session_3", snss([navigation_command(NAVIGATION, 1, 0, "https://y.com/", "Y")],
+                                              signature=b"XXXX")),
+            self.write_file("Session_4", b"SN"),
+            self.write_file("Session_5", snss([
+                navigation_command(NAVIGATION, 2, 0, "https://a.com/", "A"),
+                navigation_command(NAVIGATION, 2, 1, "https://b.com/", "B"),
+            ])),
+        ]
+        with self.assertLogs("googlechrometoolkit.sessions", level="ERROR") as logs:
+            navigations = list(iter_unique_navigations(files))
+        self.assertEqual(["https://a.com/", "https://b.com/"], [n.url for n in navigations])
+        self.assertEqual(2, len(logs.records))
+
+
+if __name__ == '__main__':
+    unittest.main()
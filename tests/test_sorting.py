@@ -0,0 +1,83 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from googlechrometoolkit.exporters import Field
+from googlechrometoolkit.sorting import ExternalSorter, Ordering, SortKey, sort_in_memory
+
+# About 80 rows per sorted run
+TINY_MEMORY_BUDGET_MB = 0.02
+
+
+class Row:
+    def __init__(self, idx, title, visit_count):
+        self.idx = idx
+        self.title = title
+        self.visit_count = visit_count
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+def create_rows(count, seed=42):
+    rnd = random.Random(seed)
+    # Few distinct values with missing ones, so ties are broken by the following keys or the original order
+    return [Row(i, rnd.choice(["a", "b", "c", None]), rnd.choice([1, 2, 3, None])) for i in range(count)]
+
+
+class ExternalSorterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def sort_and_compare(self, sort_keys, count=1000):
+        expected = [r.idx for r in sort_in_memory(create_rows(count), sort_keys)]
+        sorter = ExternalSorter(sort_keys, memory_budget_mb=TINY_MEMORY_BUDGET_MB, tmp_dir=self.tmp_dir)
+        with sorter.sort(iter(create_rows(count))) as sorted_rows:
+            self.assertGreater(len(sorted_rows.run_files), 1)
+            self.assertEqual(expected, [r.idx for r in sorted_rows])
+            # Sorted rows can be iterated again, without sorting them again
+            self.assertEqual(expected, [r.idx for r in sorted_rows])
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+    def test_mixed_orderings(self):
+        self.sort_and_compare([SortKey(Field.TITLE, Ordering.ASC), SortKey(Field.VISIT_COUNT, Ordering.DESC)])
+        self.sort_and_compare([SortKey(Field.TITLE, Ordering.DESC), SortKey(Field.VISIT_COUNT, Ordering.ASC)])
+
+    def test_same_orderings(self):
+        self.sort_and_compare([SortKey(Field.TITLE, Ordering.ASC), SortKey(Field.VISIT_COUNT, Ordering.ASC)])
+        self.sort_and_compare([SortKey(Field.TITLE, Ordering.DESC), SortKey(Field.VISIT_COUNT, Ordering.DESC)])
+
+    def test_missing_values_are_smallest(self):
+        rows = [Row(0, "b", 1), Row(1, None, 2), Row(2, "a", 3)]
+        self.assertEqual([1, 2, 0], [r.idx for r in sort_in_memory(rows, [SortKey(Field.TITLE)])])
+        self.sort_and_compare([SortKey(Field.VISIT_COUNT, Ordering.DESC)])
+
+    def test_spooling_without_sort_keys_keeps_order(self):
+        self.sort_and_compare([])
+
+    def test_rows_within_budget_are_not_spilled(self):
+        sorter = ExternalSorter([SortKey(Field.TITLE)], tmp_dir=self.tmp_dir)
+        sorted_rows = sorter.sort(iter(create_rows(100)))
+        self.assertEqual([], sorted_rows.run_files)
+        self.assertEqual([r.idx for r in sort_in_memory(create_rows(100), [SortKey(Field.TITLE)])],
+                         [r.idx for r in sorted_rows])
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+    def test_run_files_removed_if_source_fails(self):
+        def rows():
+            yield from create_rows(1000)
+            raise ValueError("Source failed")
+
+        sorter = ExternalSorter([SortKey(Field.TITLE)], memory_budget_mb=TINY_MEMORY_BUDGET_MB, tmp_dir=self.tmp_dir)
+        with self.assertRaises(ValueError):
+            sorter.sort(rows())
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()